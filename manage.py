@@ -6,6 +6,8 @@ from flask_script import Manager
 from osrc import create_app
 from osrc.manage import (
     CreateTablesCommand, DropTablesCommand, UpdateCommand,
+    MigrateHistogramsCommand, BenchmarkCommand, RefreshCommand,
+    GeocodeCommand, SimilarityCommand, PruneSocialCommand, CompactCommand,
 )
 
 if __name__ == "__main__":
@@ -16,5 +18,12 @@ if __name__ == "__main__":
     manager.add_command("create", CreateTablesCommand())
     manager.add_command("drop", DropTablesCommand())
     manager.add_command("update", UpdateCommand())
+    manager.add_command("migrate-histograms", MigrateHistogramsCommand())
+    manager.add_command("benchmark", BenchmarkCommand())
+    manager.add_command("refresh", RefreshCommand())
+    manager.add_command("geocode", GeocodeCommand())
+    manager.add_command("similarity", SimilarityCommand())
+    manager.add_command("prune-social", PruneSocialCommand())
+    manager.add_command("compact", CompactCommand())
 
     manager.run()
@@ -7,7 +7,9 @@ __all__ = ["create_app"]
 
 
 def before_first_request():
-    pass
+    # Send the Lua scripts to Redis so that they can be called by SHA.
+    from .scripts import scripts
+    scripts.load()
 
 
 def create_app(config_filename=None):
@@ -18,6 +20,10 @@ def create_app(config_filename=None):
     if config_filename is not None:
         app.config.from_pyfile(config_filename)
 
+    # Load the static resources once for the whole process.
+    from .utils import init_resources
+    init_resources(app)
+
     # Rate limiting
     from .rate_limit import limiter
     limiter.init_app(app)
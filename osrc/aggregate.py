@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from collections import defaultdict
+
+from .redis import format_key
+from .scripts import scripts
+from .social import capped_zincrby
+from .histogram import histogram_key, bitfield_args
+from .distinct import week_index, distinct_key
+from .buckets import bucket_key
+
+__all__ = ["Aggregator", "EventBatch"]
+
+
+class Aggregator(object):
+    """
+    Collects the Redis counter updates for a batch of events in memory so
+    that repeated increments of the same (key, member) pair are folded into
+    a single command when the batch is flushed.
+
+    """
+
+    # The maximum number of commands to queue on a pipeline before sending.
+    chunksize = 10000
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.zsets = defaultdict(lambda: defaultdict(int))
+        self.capped = defaultdict(lambda: defaultdict(int))
+        self.bitfields = defaultdict(lambda: defaultdict(int))
+        self.hlls = defaultdict(set)
+        self.ttls = dict()
+
+    # In all of these, ``ttl`` overrides the lifetime given to `flush`.
+
+    def zincrby(self, key, member, amount=1, capped=False, ttl=None):
+        # The capped zsets are trimmed to their top members when flushed.
+        if capped:
+            self.capped[key][member] += amount
+        else:
+            self.zsets[key][member] += amount
+        if ttl is not None:
+            self.ttls[key] = ttl
+
+    def bitfield_incrby(self, key, slot, amount=1, ttl=None):
+        self.bitfields[key][slot] += amount
+        if ttl is not None:
+            self.ttls[key] = ttl
+
+    def pfadd(self, key, member, ttl=None):
+        self.hlls[key].add(member)
+        if ttl is not None:
+            self.ttls[key] = ttl
+
+    def flush(self, pipe, ttl, cap=None):
+        ncmd = 0
+        if cap is None:
+            for key, counts in self.capped.items():
+                for member, amount in counts.items():
+                    self.zsets[key][member] += amount
+        else:
+            for key, counts in self.capped.items():
+                capped_zincrby(pipe, format_key(key), counts, cap,
+                               self.ttls.get(key, ttl))
+                ncmd += 1
+                if len(pipe.command_stack) >= self.chunksize:
+                    scripts.execute(pipe)
+
+        for key, counts in self.zsets.items():
+            expire = self.ttls.get(key, ttl)
+            key = format_key(key)
+            for member, amount in counts.items():
+                pipe.zincrby(key, member, amount)
+            pipe.expire(key, expire)
+            ncmd += len(counts) + 1
+            if len(pipe.command_stack) >= self.chunksize:
+                scripts.execute(pipe)
+
+        # All the slots of a histogram are updated by one BITFIELD command.
+        for key, counts in self.bitfields.items():
+            expire = self.ttls.get(key, ttl)
+            key = format_key(key)
+            pipe.execute_command("BITFIELD", key, *bitfield_args(counts))
+            pipe.expire(key, expire)
+            ncmd += 2
+            if len(pipe.command_stack) >= self.chunksize:
+                scripts.execute(pipe)
+
+        for key, members in self.hlls.items():
+            pipe.pfadd(format_key(key), *members)
+            pipe.expire(format_key(key), self.ttls.get(key, ttl))
+            ncmd += 2
+            if len(pipe.command_stack) >= self.chunksize:
+                scripts.execute(pipe)
+        scripts.execute(pipe)
+        self.clear()
+        return ncmd
+
+
+class EventBatch(object):
+    """
+    A columnar buffer of the event fields that feed the Redis counters. The
+    counters for the whole batch are computed with vectorized operations in
+    :func:`EventBatch.aggregate` instead of one event at a time.
+
+    """
+
+    def __init__(self):
+        self.actors = []
+        self.repos = []
+        self.types = []
+        self.timestamps = []
+        self.type_names = []
+        self.type_codes = dict()
+
+    def __len__(self):
+        return len(self.actors)
+
+    def append(self, actor, repo, evt, created_at):
+        # Parse the time first so that a malformed event raises before
+        # anything is buffered and only that event is skipped. The trailing
+        # "Z" is dropped since the archive times are all in UTC.
+        timestamp = np.datetime64(created_at[:19], "s")
+        code = self.type_codes.get(evt)
+        if code is None:
+            code = self.type_codes[evt] = len(self.type_names)
+            self.type_names.append(evt)
+        self.actors.append(actor)
+        self.repos.append(repo)
+        self.types.append(code)
+        self.timestamps.append(timestamp)
+
+    def columns(self):
+        times = np.array(self.timestamps, dtype="datetime64[s]")
+        days = times.astype("datetime64[D]").astype(np.int64)
+        months = times.astype("datetime64[M]").astype(np.int64)
+        return dict(
+            actor=np.array(self.actors, dtype=np.int64),
+            repo=np.array(self.repos, dtype=np.int64),
+            type=np.array(self.types, dtype=np.int64),
+            # 1970-01-01 was a Thursday.
+            weekday=(days + 3) % 7,
+            week=week_index(days),
+            hour=(times.astype(np.int64) // 3600) % 24,
+            # YYYYMM
+            month=(months // 12 + 1970) * 100 + months % 12 + 1,
+        )
+
+    def aggregate(self, counts, window_ttl=None, bucket_ttl=None):
+        if not len(self):
+            return
+        cols = self.columns()
+        names = self.type_names
+        actor, repo, evt = cols["actor"], cols["repo"], cols["type"]
+        month = cols["month"]
+
+        # Each count goes to the total and, if ``bucket_ttl`` is given, to
+        # the bucket for the month of the events.
+        def zincrby(key, member, c, m, **kwargs):
+            counts.zincrby(key, member, c, **kwargs)
+            if bucket_ttl is not None:
+                counts.zincrby(bucket_key(key, m), member, c, ttl=bucket_ttl,
+                               **kwargs)
+
+        # Social counts
+        for (u, r, m), c in unique_rows(actor, repo, month):
+            zincrby("u:{0}:r".format(u), r, c, m, capped=True)
+            zincrby("r:{0}:u".format(r), u, c, m, capped=True)
+            counts.pfadd(distinct_key("u", u), r)
+            counts.pfadd(distinct_key("r", r), u)
+
+        # Weekly distinct counts
+        if window_ttl is not None:
+            for (u, r, w), _ in unique_rows(actor, repo, cols["week"]):
+                counts.pfadd(distinct_key("u", u, w), r, ttl=window_ttl)
+                counts.pfadd(distinct_key("r", r, w), u, ttl=window_ttl)
+
+        # User-event counts and histogram
+        for (u, e, m), c in unique_rows(actor, evt, month):
+            zincrby("u:{0}:e".format(u), names[e], c, m)
+        slot = cols["weekday"] * 24 + cols["hour"]
+        for (u, e, s, m), c in unique_rows(actor, evt, slot, month):
+            key = histogram_key(u, names[e])
+            counts.bitfield_incrby(key, s, c)
+            if bucket_ttl is not None:
+                counts.bitfield_incrby(bucket_key(key, m), s, c,
+                                       ttl=bucket_ttl)
+
+        # Repo-event counts
+        for (r, e, m), c in unique_rows(repo, evt, month):
+            zincrby("r:{0}:e".format(r), names[e], c, m)
+
+
+def unique_rows(*columns):
+    rows, counts = np.unique(np.stack(columns, axis=1), axis=0,
+                             return_counts=True)
+    return zip(rows.tolist(), counts.tolist())
@@ -1,32 +1,65 @@
 # -*- coding: utf-8 -*-
 
+import gzip
+import json
+import zlib
 import flask
-from functools import wraps
 
-from .stats import user_stats, repo_stats
+from .cache import Payload
+from .stats import (USER_FIELDS, REPO_FIELDS, user_payload, repo_payload,
+                    user_payloads, repo_payloads)
 
 __all__ = ["api"]
 
 api = flask.Blueprint("api", __name__)
 
 
-# JSONP support.
-# Based on: https://gist.github.com/aisipos/1094140
-def jsonp(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        callback = flask.request.args.get("callback", False)
-        if callback:
-            r = f(*args, **kwargs)
-            content = "{0}({1})".format(callback, r.data.decode("utf-8"))
-            mime = "application/javascript"
-            resp = flask.current_app.response_class(content, mimetype=mime,
-                                                    status=r.status_code)
+def payload_response(payload):
+    """
+    Build the response for a cached stats payload. The ETag is the hash of
+    the payload so that clients can revalidate with ``If-None-Match`` and,
+    if the client accepts it, the body is compressed (using the precomputed
+    gzip body when there is one).
+
+    """
+    body = payload.body
+    etag = payload.etag
+    mime = "application/json"
+
+    # JSONP support.
+    # Based on: https://gist.github.com/aisipos/1094140
+    callback = flask.request.args.get("callback", False)
+    if callback:
+        body = "{0}({1})".format(callback, body.decode("utf-8"))
+        body = body.encode("utf-8")
+        etag = "{0}-{1:x}".format(etag, zlib.crc32(callback.encode("utf-8")))
+        mime = "application/javascript"
+
+    encoding = flask.request.accept_encodings.best_match(["gzip", "deflate"])
+    if encoding == "gzip":
+        if payload.gzipped is not None and not callback:
+            body = payload.gzipped
         else:
-            resp = f(*args, **kwargs)
-        resp.headers["Access-Control-Allow-Origin"] = "*"
-        return resp
-    return decorated_function
+            body = gzip.compress(body)
+        etag += "-gzip"
+    elif encoding == "deflate":
+        body = zlib.compress(body)
+        etag += "-deflate"
+
+    resp = flask.current_app.response_class(body, mimetype=mime)
+    if encoding is not None:
+        resp.headers["Content-Encoding"] = encoding
+    resp.headers["Vary"] = "Accept-Encoding"
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    resp.set_etag(etag)
+    return resp.make_conditional(flask.request)
+
+
+@api.errorhandler(400)
+def error_handler_400(e):
+    resp = flask.jsonify(message=e.description)
+    resp.status_code = 400
+    return resp
 
 
 @api.errorhandler(404)
@@ -43,21 +76,98 @@ def error_handler_403(e):
     return resp
 
 
+def get_window():
+    # The optional number of months to compute the stats over.
+    window = flask.request.args.get("window", None)
+    if window is None:
+        return None
+    retention = flask.current_app.config["COUNTER_RETENTION_MONTHS"]
+    if not window.isdigit() or not 1 <= int(window) <= retention:
+        return flask.abort(400, "Invalid window")
+    return int(window)
+
+
+def get_fields(allowed):
+    # The optional comma separated list of the sections to include.
+    fields = flask.request.args.get("fields", None)
+    if fields is None:
+        return None
+    fields = [f.strip() for f in fields.split(",") if f.strip()]
+    if not len(fields) or not set(fields) <= set(allowed):
+        return flask.abort(400, "Invalid fields")
+    return fields
+
+
 @api.route("/<username>", strict_slashes=False)
-@jsonp
 def user(username=None):
-    stats = user_stats(username)
-    if stats is None:
+    payload = user_payload(username, compressed=True, window=get_window(),
+                           fields=get_fields(USER_FIELDS))
+    if payload is None:
         return flask.abort(404)
-    if stats is False:
+    if payload is False:
         return flask.abort(403)
-    return flask.jsonify(stats)
+    return payload_response(payload)
 
 
 @api.route("/<username>/<reponame>", strict_slashes=False)
-@jsonp
 def repo(username=None, reponame=None):
-    stats = repo_stats(username, reponame)
-    if stats is None:
+    payload = repo_payload(username, reponame, compressed=True,
+                           window=get_window(),
+                           fields=get_fields(REPO_FIELDS))
+    if payload is None:
         return flask.abort(404)
-    return flask.jsonify(stats)
+    if payload is False:
+        return flask.abort(403)
+    return payload_response(payload)
+
+
+def _batch_names(body, name):
+    names = body.get(name, [])
+    if (not isinstance(names, list) or
+            not all(isinstance(n, str) for n in names)):
+        return flask.abort(400, "'{0}' must be a list of names".format(name))
+    return names
+
+
+def _batch_entries(payloads):
+    # The cached bodies are already serialized so they are spliced into the
+    # response as they are.
+    entries = []
+    for name, payload in sorted(payloads.items()):
+        if payload is None:
+            value = b"null"
+        elif payload is False:
+            value = b'{"opted_out": true}'
+        else:
+            value = payload.body
+        entries.append(json.dumps(name).encode("utf-8") + b": " + value)
+    return b"{" + b", ".join(entries) + b"}"
+
+
+@api.route("/batch", methods=["POST"], strict_slashes=False)
+def batch():
+    """
+    The stats for a list of users and repos in one request. The body is a
+    JSON object like ``{"users": ["login", ...], "repos": ["owner/name",
+    ...]}`` and the response maps each name to its stats, ``null`` if it is
+    unknown, or ``{"opted_out": true}``.
+
+    """
+    body = flask.request.get_json(force=True, silent=True)
+    if not isinstance(body, dict):
+        return flask.abort(400, "Invalid request body")
+    usernames = _batch_names(body, "users")
+    repos = _batch_names(body, "repos")
+    if len(usernames) + len(repos) > flask.current_app.config["API_BATCH_MAX"]:
+        return flask.abort(400, "Too many names")
+    if not all(len(r.split("/")) == 2 for r in repos):
+        return flask.abort(400, "Invalid repo name")
+
+    # The fields apply to the users and the repos that have them.
+    window = get_window()
+    fields = get_fields(USER_FIELDS + REPO_FIELDS)
+    users = user_payloads(usernames, window=window, fields=fields)
+    repos = repo_payloads(repos, window=window, fields=fields)
+    payload = Payload(b'{"repos": ' + _batch_entries(repos) +
+                      b', "users": ' + _batch_entries(users) + b"}")
+    return payload_response(payload)
@@ -2,6 +2,8 @@
 
 __all__ = ["Downloader"]
 
+import os
+import tempfile
 from functools import partial
 
 from tornado import ioloop
@@ -9,29 +11,51 @@ from tornado import httpclient
 
 
 class Downloader(object):
+    """
+    Fetch a set of URLs concurrently, spooling each response body to a file
+    in ``directory`` (the system default temporary directory if ``None``) as
+    it arrives instead of buffering it in memory.
+
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
 
     def download(self, urls, **kwargs):
         self.urls = urls
         self.errors = []
         self.results = []
+        self.files = dict()
 
         http_client = httpclient.AsyncHTTPClient()
-        [http_client.fetch(url, partial(self.handle_request, url), **kwargs)
-         for url in urls]
+        for url in urls:
+            # Keep the name of the archive file to make the logs readable.
+            prefix = url.rsplit("/", 1)[-1].split(".")[0] + "-"
+            fh = tempfile.NamedTemporaryFile(dir=self.directory,
+                                             prefix=prefix,
+                                             suffix=".json.gz", delete=False)
+            self.files[url] = fh
+            http_client.fetch(url, partial(self.handle_request, url),
+                              streaming_callback=fh.write, **kwargs)
         ioloop.IOLoop.instance().start()
 
         if len(self.errors):
             for k, (code, error) in self.errors:
                 print(k, code, error)
+            for _, fn in self.results:
+                os.remove(fn)
             raise RuntimeError("{0} errors".format(len(self.errors)))
 
         return dict(self.results)
 
     def handle_request(self, url, response):
+        fh = self.files.pop(url)
+        fh.close()
         if response.error:
+            os.remove(fh.name)
             self.errors.append((url, (response.code, response.error)))
         else:
-            self.results.append((url, response.body))
+            self.results.append((url, fh.name))
 
         if (len(self.results) + len(self.errors)) == len(self.urls):
             ioloop.IOLoop.instance().stop()
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+import os
+import gzip
+import json
+import time
+import shutil
+import resource
+import tempfile
+import tracemalloc
+import numpy as np
+from datetime import datetime, timedelta
+
+from .update import Parser
+
+__all__ = ["generate_archive", "run_benchmark"]
+
+# The approximate mix of event types in the GitHub Archive.
+default_event_mix = dict(
+    PushEvent=0.5,
+    CreateEvent=0.12,
+    WatchEvent=0.1,
+    IssueCommentEvent=0.08,
+    PullRequestEvent=0.06,
+    IssuesEvent=0.05,
+    ForkEvent=0.03,
+    DeleteEvent=0.03,
+    PullRequestReviewCommentEvent=0.02,
+    GollumEvent=0.01,
+)
+
+languages = [None, "Python", "JavaScript", "Go", "C", "Ruby", "Rust", "Java"]
+
+
+def zipf_weights(n, skew):
+    weights = 1.0 / np.arange(1, n + 1) ** skew
+    return weights / weights.sum()
+
+
+def parse_mix(mix):
+    """
+    Parse an event mix given as ``"PushEvent=0.7,WatchEvent=0.3"``.
+
+    """
+    if mix is None:
+        return default_event_mix
+    return dict((k.strip(), float(v)) for k, v in
+                (pair.split("=") for pair in mix.split(",")))
+
+
+def generate_archive(filename, nevents=10000, nusers=2000, nrepos=5000,
+                     skew=1.1, mix=None, hour=None, seed=None):
+    """
+    Write a synthetic GitHub Archive file with ``nevents`` events for one
+    hour. Actors and repos are drawn from Zipf distributions with exponent
+    ``skew`` so that a few hot keys get most of the traffic, like in the
+    real archive.
+
+    """
+    rng = np.random.RandomState(seed)
+    if mix is None:
+        mix = default_event_mix
+    if hour is None:
+        hour = datetime(2016, 1, 1)
+    types = sorted(mix.keys())
+    p = np.array([mix[k] for k in types], dtype=float)
+
+    evts = rng.choice(len(types), size=nevents, p=p / p.sum())
+    actors = rng.choice(nusers, size=nevents, p=zipf_weights(nusers, skew))
+    repos = rng.choice(nrepos, size=nevents, p=zipf_weights(nrepos, skew))
+    seconds = np.sort(rng.randint(3600, size=nevents))
+
+    with gzip.open(filename, "wt") as f:
+        for i in range(nevents):
+            actor = _user(int(actors[i]) + 1)
+            repo = int(repos[i]) + 1
+            owner = _user(repo % nusers + 1)
+            evt = dict(
+                id="{0}".format(i),
+                type=types[evts[i]],
+                public=True,
+                actor=actor,
+                repo=dict(
+                    id=repo,
+                    name="{0}/repo{1}".format(owner["login"], repo),
+                    url="https://api.github.com/repos/{0}/repo{1}"
+                        .format(owner["login"], repo),
+                ),
+                payload=_payload(types[evts[i]], rng, actor, owner, repo,
+                                 nrepos + i + 1),
+                created_at=(hour + timedelta(seconds=int(seconds[i])))
+                           .strftime("%Y-%m-%dT%H:%M:%SZ"),
+            )
+            f.write(json.dumps(evt))
+            f.write("\n")
+
+
+def _user(id):
+    return dict(
+        id=id,
+        login="user{0}".format(id),
+        gravatar_id="",
+        avatar_url="https://avatars.githubusercontent.com/u/{0}?"
+                   .format(id),
+        url="https://api.github.com/users/user{0}".format(id),
+    )
+
+
+def _full_repo(rng, id, owner, fork=False):
+    return dict(
+        id=id,
+        name="repo{0}".format(id),
+        full_name="{0}/repo{1}".format(owner["login"], id),
+        owner=owner,
+        fork=fork,
+        description="Synthetic repository {0}".format(id),
+        language=languages[id % len(languages)],
+        stargazers_count=int(rng.randint(1000)),
+        subscribers_count=int(rng.randint(100)),
+        forks_count=int(rng.randint(100)),
+        open_issues_count=int(rng.randint(50)),
+        updated_at="2016-01-01T00:00:00Z",
+    )
+
+
+def _payload(evt, rng, actor, owner, repo, fork_id):
+    if evt == "ForkEvent":
+        return dict(forkee=_full_repo(rng, fork_id, actor, fork=True))
+    if evt in ("PullRequestEvent", "PullRequestReviewCommentEvent"):
+        return dict(pull_request=dict(
+            base=dict(repo=_full_repo(rng, repo, owner)),
+        ))
+    return dict()
+
+
+def _measure(trace_memory, func, *args):
+    if trace_memory:
+        tracemalloc.start()
+    strt = time.time()
+    value = func(*args)
+    dt = time.time() - strt
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return value, dt, peak
+
+
+def run_benchmark(nfiles=1, nevents=100000, nusers=20000, nrepos=50000,
+                  skew=1.1, mix=None, seed=None, skip_db=False,
+                  trace_memory=False, directory=None):
+    """
+    Generate ``nfiles`` synthetic hourly archives and run them through the
+    stages of :class:`osrc.update.Parser`, reporting the throughput of each
+    stage. The counters are written to the configured Redis server and the
+    users and repos are merged into the configured database unless
+    ``skip_db`` is set, so the app should be pointed at scratch instances.
+    The flush uses Lua scripts, ``BITFIELD`` and HyperLogLogs so it needs a
+    real Redis server (3.2 or newer).
+
+    """
+    cleanup = directory is None
+    if cleanup:
+        directory = tempfile.mkdtemp()
+
+    # Generate the archive files.
+    rng = np.random.RandomState(seed)
+    files = []
+    strt = time.time()
+    for n in range(nfiles):
+        fn = os.path.join(directory, "synthetic-{0}.json.gz".format(n))
+        generate_archive(fn, nevents=nevents, nusers=nusers, nrepos=nrepos,
+                         skew=skew, mix=mix, seed=rng.randint(2**31),
+                         hour=datetime(2016, 1, 1) + timedelta(hours=n))
+        files.append(fn)
+    print("generated {0} files in {1} seconds"
+          .format(nfiles, time.time() - strt))
+
+    # Run the parser stages on each file.
+    stages = ["read", "flush_counts"]
+    if not skip_db:
+        stages += ["load_tables", "merge_tables"]
+    times = dict((k, 0.0) for k in stages)
+    peaks = dict((k, 0) for k in stages)
+    totals = dict(events=0, commands=0, rows=0)
+    parser = Parser()
+    try:
+        for fn in files:
+            parser.reset()
+            for stage in stages:
+                args = (fn, ) if stage == "read" else ()
+                value, dt, peak = _measure(trace_memory,
+                                           getattr(parser, stage), *args)
+                times[stage] += dt
+                if peak is not None:
+                    peaks[stage] = max(peaks[stage], peak)
+                if stage == "read":
+                    totals["events"] += value
+                elif stage == "flush_counts":
+                    totals["commands"] += value
+                elif stage == "load_tables":
+                    totals["rows"] += value
+            if not skip_db:
+                parser.connection.commit()
+    finally:
+        if parser.connection is not None:
+            parser.connection.rollback()
+        if cleanup:
+            shutil.rmtree(directory)
+
+    def rate(n, dt):
+        return n / dt if dt > 0 else None
+
+    results = dict(
+        files=nfiles,
+        events=totals["events"],
+        redis_commands=totals["commands"],
+        rows=totals["rows"],
+        seconds=times,
+        events_per_second=rate(totals["events"], times["read"]),
+        redis_commands_per_second=rate(totals["commands"],
+                                       times["flush_counts"]),
+        max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    )
+    if not skip_db:
+        results["rows_per_second"] = rate(
+            totals["rows"], times["load_tables"] + times["merge_tables"])
+    if trace_memory:
+        results["peak_memory_bytes"] = peaks
+    return results
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import time
+import flask
+import calendar
+import numpy as np
+
+from .redis import get_connection, format_key
+from .scripts import scripts
+from .social import floor_key
+from .histogram import bitfield_args, decode_histogram
+
+__all__ = ["bucket_key", "year_key", "bucket_ttl", "recent_months",
+           "window_keys", "merged_zset", "merged_zsets", "compact_buckets"]
+
+# Every u:* and r:* counter also has one bucket per calendar month, named
+# {key}:m:{YYYYMM}, holding the counts of the events in that month. The
+# totals are cumulative and are never reduced by compaction, which rolls the
+# buckets older than COUNTER_RETENTION_MONTHS into one yearly aggregate per
+# counter, named {key}:y:{YYYY}, that is kept for COUNTER_ARCHIVE_YEARS more
+# years.
+
+
+def bucket_key(key, month):
+    return "{0}:m:{1}".format(key, month)
+
+
+def year_key(key, year):
+    return "{0}:y:{1}".format(key, year)
+
+
+def _yyyymm(index):
+    return (1970 + index // 12) * 100 + index % 12 + 1
+
+
+def bucket_ttl():
+    # The buckets outlive the retention so that compaction can still
+    # subtract them from the totals.
+    months = flask.current_app.config["COUNTER_RETENTION_MONTHS"] + 2
+    return months * 31 * 24 * 60 * 60
+
+
+def recent_months(n, now=None):
+    """
+    The ``YYYYMM`` names of the last ``n`` months, including the current one.
+
+    """
+    if now is None:
+        now = time.time()
+    current = int(np.datetime64(int(now), "s").astype("datetime64[M]")
+                  .astype(np.int64))
+    return [_yyyymm(current - i) for i in range(n)]
+
+
+def window_keys(key, window):
+    """
+    The (formatted) names of the last ``window`` monthly buckets of ``key``.
+
+    """
+    return [format_key(bucket_key(key, m)) for m in recent_months(window)]
+
+
+def merged_zset(key, window, ttl=60):
+    """
+    Merge the last ``window`` monthly buckets of the zset ``key`` into a
+    temporary key with ``ZUNIONSTORE`` and return its (formatted) name.
+
+    """
+    return merged_zsets([key], window, ttl=ttl)[0]
+
+
+def merged_zsets(keys, window, ttl=60):
+    # The same as `merged_zset` for a list of keys, in one pipeline.
+    months = recent_months(window)
+    dests = []
+    with get_connection().pipeline() as pipe:
+        for key in keys:
+            dest = format_key("{0}:mw:{1}:{2}".format(key, months[-1],
+                                                     months[0]))
+            pipe.zunionstore(dest, window_keys(key, window))
+            pipe.expire(dest, ttl)
+            dests.append(dest)
+        pipe.execute()
+    return dests
+
+
+def compact_buckets(retention=None, batch=1000, now=None):
+    """
+    Roll the monthly buckets that are older than ``retention`` months
+    (default: ``COUNTER_RETENTION_MONTHS``) into the yearly aggregates and
+    delete them. The totals aren't changed. Returns the number of buckets
+    that were compacted.
+
+    """
+    config = flask.current_app.config
+    if retention is None:
+        retention = config["COUNTER_RETENTION_MONTHS"]
+    cutoff = recent_months(retention, now=now)[-1]
+    prefix = format_key("")
+    conn = get_connection()
+    count = 0
+    for pattern in ["u:*:m:*", "r:*:m:*"]:
+        keys = []
+        for key in conn.scan_iter(match=format_key(pattern), count=batch):
+            key = key.decode("ascii")[len(prefix):]
+            base, _, month = key.rpartition(":m:")
+            if not month.isdigit() or int(month) >= cutoff:
+                continue
+            keys.append((base, key, int(month) // 100))
+            if len(keys) >= batch:
+                count += _compact_batch(conn, keys, config)
+                keys = []
+        if len(keys):
+            count += _compact_batch(conn, keys, config)
+    return count
+
+
+def _year_expiry(year, config):
+    # The start of the year after the archived years.
+    return calendar.timegm(
+        (year + 1 + config["COUNTER_ARCHIVE_YEARS"], 1, 1, 0, 0, 0))
+
+
+def _compact_batch(conn, keys, config):
+    # The histograms are BITFIELD strings; the rest are zsets. The social
+    # zsets are capped like their totals.
+    cap = config["SOCIAL_ZSET_CAP"] or 0
+    hists = [(b, k, y) for b, k, y in keys if b.split(":")[2] == "b"]
+    with conn.pipeline(transaction=False) as pipe:
+        for _, key, _ in hists:
+            pipe.get(format_key(key))
+        values = pipe.execute()
+
+        for (base, key, year), value in zip(hists, values):
+            hist = decode_histogram(value).ravel()
+            counts = dict((int(s), int(hist[s]))
+                          for s in np.flatnonzero(hist))
+            if len(counts):
+                dest = format_key(year_key(base, year))
+                pipe.execute_command("BITFIELD", dest, *bitfield_args(counts))
+                pipe.expireat(dest, _year_expiry(year, config))
+            pipe.delete(format_key(key))
+
+        for base, key, year in keys:
+            kind = base.split(":")[2]
+            if kind != "b":
+                key = format_key(key)
+                scripts.call("compact_zset",
+                             [format_key(year_key(base, year)), key,
+                              floor_key(key)],
+                             [cap if kind in ("r", "u") else 0,
+                              _year_expiry(year, config)],
+                             client=pipe)
+        scripts.execute(pipe)
+    return len(keys)
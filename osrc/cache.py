@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import flask
+import hashlib
+
+from .redis import get_connection, format_key
+
+__all__ = ["Payload", "get_cached", "get_cached_many", "invalidate"]
+
+
+class Payload(object):
+    """
+    A serialized stats payload along with its ETag and, optionally, a
+    gzip compressed copy of the body.
+
+    """
+
+    def __init__(self, body, etag=None, gzipped=None):
+        self.body = body
+        if etag is None:
+            etag = hashlib.sha1(body).hexdigest()
+        self.etag = etag
+        self.gzipped = gzipped
+
+    @classmethod
+    def from_data(cls, data, compress=True):
+        body = json.dumps(data, sort_keys=True).encode("utf-8")
+        return cls(body, gzipped=gzip.compress(body) if compress else None)
+
+    @property
+    def data(self):
+        return json.loads(self.body.decode("utf-8"))
+
+
+def _cache_key(flag, id, variant=None):
+    if variant is None:
+        return format_key("x:{0}:{1}".format(flag, id))
+    return format_key("x:{0}:{1}:{2}".format(flag, id, variant))
+
+
+def _version_key(flag, id):
+    return format_key("x:{0}:{1}:v".format(flag, id))
+
+
+def get_cached(flag, id, compute, compressed=False, variant=None):
+    """
+    Get the computed stats for the user (``flag="u"``) or repo
+    (``flag="r"``) with a given id from the cache, or call ``compute`` and
+    cache the result. The result is returned as a :class:`Payload` that
+    includes the gzipped body if ``compressed`` is set. Different
+    ``variant`` strings (e.g. for a subset of the stats) are cached
+    separately.
+
+    Each payload is stored with a freshness marker that expires after
+    ``STATS_CACHE_TTL`` seconds and with the version of the entity that it
+    was computed from. The ingestion bumps the version of everything it
+    touches so all of the variants go stale at once. The payload itself is
+    kept for another ``STATS_CACHE_STALE_TTL`` seconds and, while it is
+    stale, only the request that takes the lock recomputes it. Everyone
+    else gets the stale copy.
+
+    """
+    return get_cached_many(flag, [id], lambda ids: {id: compute()},
+                           compressed=compressed, variant=variant)[id]
+
+
+def get_cached_many(flag, ids, compute, compressed=False, variant=None):
+    """
+    The same as :func:`get_cached` for a list of ids, using one pipeline
+    for each step. ``compute`` is called once with the list of ids that
+    need to be computed and returns a dictionary of the results. Returns a
+    dictionary of :class:`Payload` objects (or ``None``) keyed by id.
+
+    """
+    config = flask.current_app.config
+    keys = [_cache_key(flag, id, variant) for id in ids]
+    conn = get_connection()
+    fields = ["version", "body", "etag"] + (["gzip"] if compressed else [])
+    with conn.pipeline() as pipe:
+        for id, key in zip(ids, keys):
+            pipe.hmget(key, fields)
+            pipe.exists(key + ":f")
+            pipe.get(_version_key(flag, id))
+        results = pipe.execute()
+
+    payloads = dict()
+    versions = dict()
+    stale = []
+    for id, key, values, fresh, version in zip(
+            ids, keys, results[::3], results[1::3], results[2::3]):
+        versions[id] = version = int(version or 0)
+        if values[1] is None:
+            continue
+        payloads[id] = Payload(values[1], values[2].decode("ascii"),
+                               values[3] if compressed else None)
+        if not fresh or int(values[0] or 0) != version:
+            stale.append((id, key))
+
+    # Only recompute the stale payloads that nobody else is working on.
+    locked = []
+    if len(stale):
+        with conn.pipeline(transaction=False) as pipe:
+            for _, key in stale:
+                pipe.set(key + ":l", 1, nx=True,
+                         ex=config["STATS_CACHE_LOCK_TTL"])
+            locked = [id for (id, _), ok in zip(stale, pipe.execute())
+                      if ok]
+    missing = [id for id in ids if id not in payloads] + locked
+    if not len(missing):
+        return payloads
+
+    # The payloads are stored with the versions read before computing them
+    # so that anything ingested in the meantime makes them stale again.
+    values = compute(missing)
+    ttl = config["STATS_CACHE_TTL"]
+    expire = ttl + config["STATS_CACHE_STALE_TTL"]
+    with conn.pipeline() as pipe:
+        for id in missing:
+            value = values.get(id)
+            if value is None:
+                payloads[id] = None
+                continue
+            payload = payloads[id] = Payload.from_data(value)
+            key = _cache_key(flag, id, variant)
+            pipe.delete(key)
+            pipe.hmset(key, dict(body=payload.body, etag=payload.etag,
+                                 gzip=payload.gzipped,
+                                 version=versions[id]))
+            pipe.expire(key, expire)
+            pipe.set(key + ":f", 1, ex=ttl)
+            pipe.delete(key + ":l")
+            # The version has to outlive the payloads that refer to it or
+            # it could be bumped back to the same value.
+            pipe.expire(_version_key(flag, id), expire)
+        pipe.execute()
+    return payloads
+
+
+def invalidate(pipe, flag, ids):
+    """
+    Mark all of the cached stats for a set of users or repos as stale by
+    bumping their versions. The stale payloads are still served until they
+    have been recomputed. Returns the number of commands.
+
+    """
+    config = flask.current_app.config
+    expire = config["STATS_CACHE_TTL"] + config["STATS_CACHE_STALE_TTL"]
+    ids = list(ids)
+    for id in ids:
+        key = _version_key(flag, id)
+        pipe.incr(key)
+        pipe.expire(key, expire)
+    return 2 * len(ids)
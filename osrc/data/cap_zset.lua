@@ -0,0 +1,33 @@
+-- Increment the members of a social zset and trim it to its top ARGV[1]
+-- members. KEYS[2] holds the highest score evicted so far and, as in the
+-- Space-Saving heavy hitters algorithm, a member that isn't in the zset
+-- starts from that score so that it can climb back above the cutoff.
+-- ARGV: cap, ttl (0 keeps the current one), member, amount, member, ...
+local cap = tonumber(ARGV[1])
+local floor = tonumber(redis.call("GET", KEYS[2]) or "0")
+for i = 3, #ARGV, 2 do
+    local amount = tonumber(ARGV[i+1])
+    if floor > 0 and not redis.call("ZSCORE", KEYS[1], ARGV[i]) then
+        amount = amount + floor
+    end
+    redis.call("ZINCRBY", KEYS[1], amount, ARGV[i])
+end
+
+local removed = 0
+local n = redis.call("ZCARD", KEYS[1])
+if n > cap then
+    local last = redis.call("ZRANGE", KEYS[1], n-cap-1, n-cap-1, "withscores")
+    if tonumber(last[2]) > floor then
+        redis.call("SET", KEYS[2], last[2])
+    end
+    removed = redis.call("ZREMRANGEBYRANK", KEYS[1], 0, n-cap-1)
+end
+
+if tonumber(ARGV[2]) > 0 then
+    redis.call("EXPIRE", KEYS[1], ARGV[2])
+end
+local ttl = redis.call("TTL", KEYS[1])
+if ttl > 0 and redis.call("EXISTS", KEYS[2]) == 1 then
+    redis.call("EXPIRE", KEYS[2], ttl)
+end
+return removed
@@ -0,0 +1,13 @@
+-- Roll the monthly bucket KEYS[2] into the yearly aggregate KEYS[1] and
+-- delete the bucket along with its Space-Saving floor (KEYS[3]). The
+-- aggregate is trimmed to its ARGV[1] highest members (unless ARGV[1] is 0)
+-- and expires at the timestamp ARGV[2]. The total isn't touched.
+if redis.call("EXISTS", KEYS[2]) == 1 then
+    redis.call("ZUNIONSTORE", KEYS[1], 2, KEYS[1], KEYS[2])
+    local cap = tonumber(ARGV[1])
+    if cap > 0 then
+        redis.call("ZREMRANGEBYRANK", KEYS[1], 0, -cap - 1)
+    end
+    redis.call("EXPIREAT", KEYS[1], ARGV[2])
+end
+return redis.call("DEL", KEYS[2], KEYS[3])
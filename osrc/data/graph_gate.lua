@@ -0,0 +1,13 @@
+-- Read the top of the social graph KEYS[1] and decide whether the caller
+-- should rebuild it: only if its freshness marker (KEYS[2]) has expired and
+-- the caller gets the lock (KEYS[3]) for ARGV[1] seconds. Everyone else is
+-- served the current copy, even if it is stale. If ARGV[2] is 0, the graph is
+-- built elsewhere and the current copy is always served.
+local values = redis.call("ZREVRANGE", KEYS[1], 0, 4, "withscores")
+if ARGV[2] == "0" or redis.call("EXISTS", KEYS[2]) == 1 then
+    return {0, values}
+end
+if redis.call("SET", KEYS[3], 1, "NX", "EX", ARGV[1]) then
+    return {1, values}
+end
+return {0, values}
@@ -4,6 +4,8 @@ import os
 DEBUG = False
 SECRET_KEY = "development key"
 RATELIMIT_HEADERS_ENABLED = True
+# Reload the files in osrc/data when they change on disk.
+RESOURCE_RELOAD = False
 
 # Database stuff.
 pg_user = os.environ.get("POSTGRES_ENV_POSTGRES_USER", "osrc")
@@ -18,10 +20,59 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 REDIS_URI = "redis://redis:6379/0"
 REDIS_PREFIX = "osrc2"
 REDIS_DEFAULT_TTL = 6 * 30 * 24 * 60 * 60
+# The number of members kept in each u:{id}:r and r:{id}:u zset (None keeps
+# everything). Run "manage.py prune-social" after lowering it.
+SOCIAL_ZSET_CAP = 1000
+# The number of monthly buckets (u:*:m:* and r:*:m:*) that are kept for the
+# windowed stats. Run "manage.py compact" to roll the older ones into yearly
+# aggregates ({key}:y:{YYYY}), which are kept for COUNTER_ARCHIVE_YEARS more
+# years. The all-time totals aren't changed by the compaction.
+COUNTER_RETENTION_MONTHS = 6
+COUNTER_ARCHIVE_YEARS = 2
+# The windows (in weeks, counting back from the current one) of the distinct
+# repo and contributor counts.
+DISTINCT_WINDOWS = dict(week=1, month=4)
+# The social graphs (s:*) are fresh for SOCIAL_GRAPH_TTL seconds, give or
+# take SOCIAL_GRAPH_JITTER, and then served stale for up to
+# SOCIAL_GRAPH_STALE_TTL seconds while one request rebuilds them.
+SOCIAL_GRAPH_TTL = 2 * 24 * 60 * 60
+SOCIAL_GRAPH_STALE_TTL = 24 * 60 * 60
+SOCIAL_GRAPH_LOCK_TTL = 30
+SOCIAL_GRAPH_JITTER = 0.1
+# Where the friends and similar repos come from: "walk" builds them from the
+# top neighbours in the interaction counts and "similarity" uses the graphs
+# written by the offline similarity engine (see osrc/similarity.py), which
+# live for SIMILARITY_TTL seconds.
+SOCIAL_GRAPH_SOURCE = "walk"
+SIMILARITY_TTL = 8 * 24 * 60 * 60
+
+# The computed stats are served from the cache for STATS_CACHE_TTL seconds
+# and then served stale for up to STATS_CACHE_STALE_TTL more seconds while
+# they are recomputed.
+STATS_CACHE_TTL = 60 * 60
+STATS_CACHE_STALE_TTL = 24 * 60 * 60
+STATS_CACHE_LOCK_TTL = 30
+# The maximum number of users and repos in one /api/batch request.
+API_BATCH_MAX = 100
+
+# Where the archive files are spooled while they are being processed.
+ARCHIVE_SPOOL_DIR = None
+
+# The shared HTTP clients for the GitHub and Google APIs.
+HTTP_POOL_SIZE = 10
+HTTP_MAX_CONCURRENCY = 10
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+HTTP_TIMEOUT = 10
 
 # GitHub stuff.
+GITHUB_API_URL = "https://api.github.com"
 GITHUB_ID = None
 GITHUB_SECRET = None
+# Stop making API requests when fewer than this many are left in the window.
+GITHUB_RATELIMIT_RESERVE = 100
 
 # Google stuff.
 GOOGLE_KEY = None
+# How long to wait before trying to geocode a location that failed again.
+GEOCODE_NEGATIVE_TTL = 30 * 24 * 60 * 60
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import time
+import flask
+
+from .redis import get_pipeline, format_key
+
+__all__ = ["week_index", "distinct_key", "window_ttl", "distinct_counts",
+           "distinct_counts_many"]
+
+# The HyperLogLogs count the distinct repos of each user (u:{id}:hr) and the
+# distinct actors of each repo (r:{id}:hu). There is one key for all time
+# and one per week that is merged into the windows in DISTINCT_WINDOWS.
+_members = dict(u="r", r="u")
+
+
+def week_index(days):
+    # The number of weeks since the Monday before 1970-01-01 (a Thursday).
+    return (days + 3) // 7
+
+
+def distinct_key(flag, id, week=None):
+    key = "{0}:{1}:h{2}".format(flag, id, _members[flag])
+    if week is not None:
+        key += ":w:{0}".format(week)
+    return key
+
+
+def window_ttl():
+    # Keep the weekly keys for as long as the longest window needs them.
+    weeks = max(flask.current_app.config["DISTINCT_WINDOWS"].values())
+    return (weeks + 1) * 7 * 24 * 60 * 60
+
+
+def distinct_counts(flag, id, now=None):
+    """
+    The approximate number of distinct repos for a user (``flag="u"``) or
+    distinct actors for a repo (``flag="r"``), for all time (``"total"``)
+    and for each of the ``DISTINCT_WINDOWS``, which are the number of weeks
+    to merge, counting back from the current one.
+
+    """
+    return distinct_counts_many(flag, [id], now=now)[0]
+
+
+def distinct_counts_many(flag, ids, now=None):
+    # The same as `distinct_counts` for a list of ids, in one pipeline.
+    if now is None:
+        now = time.time()
+    week = week_index(int(now // 86400))
+    windows = sorted(flask.current_app.config["DISTINCT_WINDOWS"].items())
+    with get_pipeline() as pipe:
+        for id in ids:
+            pipe.pfcount(format_key(distinct_key(flag, id)))
+            for _, weeks in windows:
+                pipe.pfcount(*(format_key(distinct_key(flag, id, week - i))
+                               for i in range(weeks)))
+        counts = pipe.execute()
+    n = len(windows) + 1
+    return [dict([("total", c[0])] +
+                 list(zip((name for name, _ in windows), c[1:])))
+            for c in (counts[i:i+n] for i in range(0, len(counts), n))]
@@ -8,6 +8,7 @@ from sqlalchemy import func
 from urllib.parse import urlencode
 
 from .models import db, User
+from .httpclient import get_client
 from .utils import load_json_resource
 from .stats import user_stats, repo_stats
 
@@ -102,8 +103,11 @@ def optout_callback(username=None):
         client_secret=flask.current_app.config["GITHUB_SECRET"],
         code=code,
     )
-    r = requests.post("https://github.com/login/oauth/access_token",
-                      data=params, headers={"Accept": "application/json"})
+    # These requests don't count against the app's API rate limit so they use
+    # their own client.
+    client = get_client("github-oauth")
+    r = client.post("https://github.com/login/oauth/access_token",
+                    data=params, headers={"Accept": "application/json"})
     if r.status_code != requests.codes.ok:
         flask.flash("Couldn't acquire an access token from GitHub.")
         return flask.redirect(flask.url_for(".optout_error",
@@ -116,8 +120,8 @@ def optout_callback(username=None):
                                             username=username))
 
     # Check the username.
-    r = requests.get("https://api.github.com/user",
-                     params={"access_token": access})
+    r = client.get(flask.current_app.config["GITHUB_API_URL"] + "/user",
+                   params={"access_token": access})
     if r.status_code != requests.codes.ok:
         flask.flash("Couldn't get user information.")
         return flask.redirect(flask.url_for(".optout_error",
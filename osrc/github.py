@@ -1,21 +1,25 @@
 # -*- coding: utf-8 -*-
 
+import time
 import flask
 import requests
 from sqlalchemy import func
+from sqlalchemy.orm import joinedload
 
 from .models import db, User, Repo
+from .cache import invalidate
 from .process import process_user, process_repo
+from .httpclient import RateLimited, get_client
 from .redis import format_key, get_connection, get_pipeline
 
-__all__ = ["gh_request", "get_user", "get_repo"]
-
-API_URL = "https://api.github.com"
+__all__ = ["gh_request", "github_client", "get_user", "get_repo",
+           "get_users", "get_repos", "get_users_by_login",
+           "get_repos_by_name", "enqueue_refresh", "drain_refresh_queue"]
 
 
 def gh_request(path, method="GET", etag=None, **params):
     # Build the URL, header, and parameter set.
-    url = API_URL + path
+    url = flask.current_app.config["GITHUB_API_URL"] + path
     headers = {
         "User-Agent": "osrc",
         "Accept": "application/vnd.github.v3+json",
@@ -28,9 +32,14 @@ def gh_request(path, method="GET", etag=None, **params):
         "client_secret", flask.current_app.config["GITHUB_SECRET"])
 
     # Execute the request.
-    r = requests.get(url, headers=headers, params=params)
+    r = github_client().get(url, headers=headers, params=params)
     return r
 
+
+def github_client():
+    return get_client(
+        "github", reserve=flask.current_app.config["GITHUB_RATELIMIT_RESERVE"])
+
 def update_cache(flag, obj):
     # Update the cache flag.
     cache_key = format_key("c:{0}:{1}".format(flag, obj.id))
@@ -53,20 +62,25 @@ def get_user(username=None, id=None, user=None, use_cache=True):
         else:
             return None
 
-    # Check to see if the cache is up to date.
+    # Check to see if the cache is up to date. If it isn't, the stored copy
+    # is returned and the refresh worker updates it in the background.
     if use_cache and user is not None:
         cache_key = format_key("c:u:{0}".format(user.id))
         conn = get_connection()
         bit = conn.getbit(cache_key, 0)
-        if bit:
-            return user
+        if not bit:
+            enqueue_refresh("u", [user.id])
+        return user
 
     # Update the user information using the API.
     etag = None if user is None else user.etag
     username = user.login if username is None else username
     try:
         r = gh_request("/users/{0}".format(username), etag=etag)
-    except requests.exceptions.ConnectionError:
+    except RateLimited:
+        # The refresh worker queues the entity again when this happens.
+        raise
+    except requests.exceptions.RequestException:
         if user is not None:
             return user
         raise
@@ -98,20 +112,25 @@ def get_repo(fullname=None, id=None, repo=None, use_cache=True):
         else:
             return None
 
-    # Check to see if the cache is up to date.
+    # Check to see if the cache is up to date. If it isn't, the stored copy
+    # is returned and the refresh worker updates it in the background.
     if use_cache and repo is not None:
         cache_key = format_key("c:r:{0}".format(repo.id))
         conn = get_connection()
         bit = conn.getbit(cache_key, 0)
-        if bit:
-            return repo
+        if not bit:
+            enqueue_refresh("r", [repo.id])
+        return repo
 
     # Update the user information using the API.
     etag = None if repo is None else repo.etag
     fullname = repo.fullname if fullname is None else fullname
     try:
         r = gh_request("/repos/{0}".format(fullname), etag=etag)
-    except requests.exceptions.ConnectionError:
+    except RateLimited:
+        # The refresh worker queues the entity again when this happens.
+        raise
+    except requests.exceptions.RequestException:
         if repo is not None:
             return repo
         raise
@@ -128,3 +147,148 @@ def get_repo(fullname=None, id=None, repo=None, use_cache=True):
     db.session.commit()
     update_cache("r", repo)
     return repo
+
+
+def get_users(ids, refresh=False):
+    return _get_many(User, "u", ids, refresh,
+                     lambda u: get_user(user=u, use_cache=False))
+
+
+def get_repos(ids, refresh=False):
+    return _get_many(Repo, "r", ids, refresh,
+                     lambda r: get_repo(repo=r, use_cache=False))
+
+
+def _get_many(model, flag, ids, refresh, update):
+    # Load all of the objects with a single query. Unless ``refresh`` is set,
+    # the stored copies are returned even if their cache flag has expired and
+    # the stale ones are queued for the refresh worker.
+    ids = list(ids)
+    if not len(ids):
+        return dict()
+    objs = dict((o.id, o)
+                for o in model.query.filter(model.id.in_(ids)).all())
+    stale = stale_ids(flag, objs.keys())
+    if refresh:
+        for id in stale:
+            objs[id] = update(objs[id])
+    else:
+        enqueue_refresh(flag, stale)
+    return objs
+
+
+def get_users_by_login(logins):
+    """
+    Look up the stored users with the given logins with a single query.
+    Returns a dictionary keyed by the lowercase login. Unlike
+    :func:`get_user`, unknown users aren't fetched from GitHub.
+
+    """
+    names = list(set(l.lower() for l in logins))
+    if not len(names):
+        return dict()
+    users = User.query.filter(func.lower(User.login).in_(names)).all()
+    enqueue_refresh("u", stale_ids("u", (u.id for u in users)))
+    return dict((u.login.lower(), u) for u in users)
+
+
+def get_repos_by_name(fullnames):
+    """
+    Look up the stored repos (and their owners) with the given full names
+    with a single query. Returns a dictionary keyed by the lowercase name.
+
+    """
+    names = list(set(n.lower() for n in fullnames))
+    if not len(names):
+        return dict()
+    repos = (Repo.query.options(joinedload(Repo.owner))
+             .filter(func.lower(Repo.fullname).in_(names)).all())
+    enqueue_refresh("r", stale_ids("r", (r.id for r in repos)))
+    return dict((r.fullname.lower(), r) for r in repos)
+
+
+def stale_ids(flag, ids):
+    ids = list(ids)
+    with get_pipeline() as pipe:
+        for id in ids:
+            pipe.getbit(format_key("c:{0}:{1}".format(flag, id)), 0)
+        bits = pipe.execute()
+    return [id for id, bit in zip(ids, bits) if not bit]
+
+
+def _queue_key():
+    return format_key("q:refresh")
+
+
+def enqueue_refresh(flag, ids):
+    # The queue is a sorted set scored by the time when the entity was first
+    # queued so duplicate requests don't move it to the back of the queue.
+    ids = list(ids)
+    if not len(ids):
+        return
+    key = _queue_key()
+    now = time.time()
+    args = []
+    for id in ids:
+        args += [now, "{0}:{1}".format(flag, id)]
+    get_connection().execute_command("ZADD", key, "NX", *args)
+
+
+def drain_refresh_queue(limit=100):
+    """
+    Refresh up to ``limit`` of the oldest users and repos in the refresh
+    queue using the GitHub API. Returns the number of entities popped from
+    the queue. The cached stats of the entities that changed are marked as
+    stale. If the rate limit budget runs out, the remaining entities are
+    queued again and :class:`osrc.httpclient.RateLimited` is raised.
+
+    """
+    key = _queue_key()
+    with get_pipeline() as pipe:
+        pipe.zrange(key, 0, limit - 1)
+        pipe.zremrangebyrank(key, 0, limit - 1)
+        members = pipe.execute()[0]
+    if not len(members):
+        return 0
+
+    ids = dict(u=[], r=[])
+    for member in members:
+        flag, id = member.decode("ascii").split(":")
+        ids[flag].append(int(id))
+
+    # Skip anything that was refreshed since it was queued. The stored ETags
+    # are sent with the requests so unchanged entities cost a 304.
+    for flag, model, update in [
+            ("u", User, lambda u: get_user(user=u, use_cache=False)),
+            ("r", Repo, lambda r: get_repo(repo=r, use_cache=False))]:
+        stale = stale_ids(flag, ids[flag])
+        if not len(stale):
+            continue
+        objs = model.query.filter(model.id.in_(stale)).all()
+        changed = []
+        try:
+            for i, obj in enumerate(objs):
+                etag = obj.etag
+                try:
+                    obj = update(obj)
+                except RateLimited:
+                    # Put everything that's left back into the queue.
+                    enqueue_refresh(flag, [o.id for o in objs[i:]])
+                    if flag == "u":
+                        enqueue_refresh("r", ids["r"])
+                    raise
+                except Exception as e:
+                    db.session.rollback()
+                    print("failed to refresh {0}:{1}: {2}"
+                          .format(flag, objs[i].id, e))
+                    continue
+                # A new ETag means that the stored copy changed (instead of
+                # a 304) so the cached stats that include it are stale.
+                if obj is not None and obj.etag != etag:
+                    changed.append(obj.id)
+        finally:
+            if len(changed):
+                with get_pipeline() as pipe:
+                    invalidate(pipe, flag, changed)
+                    pipe.execute()
+    return len(members)
@@ -5,6 +5,8 @@ __all__ = ["geocode", "timezone"]
 import flask
 import requests
 
+from .httpclient import get_client
+
 GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
 TIMEZONE_URL = "https://maps.googleapis.com/maps/api/timezone/json"
 
@@ -13,7 +15,7 @@ def geocode(address, **params):
     headers = {"User-Agent": "osrc"}
     params["key"] = params.get("key", flask.current_app.config["GOOGLE_KEY"])
     params["address"] = address
-    r = requests.get(GEOCODE_URL, headers=headers, params=params)
+    r = get_client("google").get(GEOCODE_URL, headers=headers, params=params)
     if r.status_code != requests.codes.ok:
         return None
 
@@ -35,7 +37,7 @@ def timezone(address):
         timestamp=0,
     )
 
-    r = requests.get(TIMEZONE_URL, headers=headers, params=params)
+    r = get_client("google").get(TIMEZONE_URL, headers=headers, params=params)
     if r.status_code != requests.codes.ok:
         return None
 
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+import flask
+import random
+from collections import defaultdict
+
+from .scripts import scripts
+from .redis import get_connection, format_key
+
+__all__ = ["mark_touched", "refresh_graphs", "user_user_graphs",
+           "user_repo_graphs", "repo_repo_graphs", "write_graphs",
+           "expire_graphs", "user_graphs", "user_graphs_many", "repo_graphs",
+           "repo_graphs_many"]
+
+# Each social graph s:{u|r}:{id}:{u|r} has a freshness marker ({key}:f) that
+# expires after a jittered SOCIAL_GRAPH_TTL. The graph itself is kept for
+# SOCIAL_GRAPH_STALE_TTL more seconds so that, while one request rebuilds it
+# under a lock ({key}:l), the others are served the stale copy.
+
+
+def _touched_key(flag):
+    return format_key("t:{0}".format(flag))
+
+
+def mark_touched(pipe, flag, ids, chunksize=1000):
+    """
+    Record that the ingestion updated the social counts of some users
+    (``flag="u"``) or repos (``flag="r"``) so that their graphs are
+    recomputed by :func:`refresh_graphs`.
+
+    """
+    ids = list(ids)
+    key = _touched_key(flag)
+    for i in range(0, len(ids), chunksize):
+        pipe.sadd(key, *ids[i:i+chunksize])
+    return (len(ids) + chunksize - 1) // chunksize
+
+
+def _zrevrange_many(keys, stop):
+    pipe = get_connection().pipeline(transaction=False)
+    for key in keys:
+        pipe.zrevrange(format_key(key), 0, stop, withscores=True)
+    return [[(m.decode("ascii"), s) for m, s in values]
+            for values in pipe.execute()]
+
+
+def _top(scores, n):
+    return sorted(scores.items(), key=lambda x: -x[1])[:n]
+
+
+def user_user_graphs(ids):
+    repos = _zrevrange_many(["u:{0}:r".format(id) for id in ids], 5)
+    repo_ids = list(set(r for values in repos for r, _ in values))
+    users = dict(zip(repo_ids, _zrevrange_many(
+        ["r:{0}:u".format(r) for r in repo_ids], 5)))
+
+    results = dict()
+    for id, values in zip(ids, repos):
+        scores = defaultdict(float)
+        for repo, repo_score in values:
+            for user, user_score in users[repo]:
+                if user != id:
+                    scores[user] += repo_score + user_score
+        results[id] = scores
+    return results
+
+
+def user_repo_graphs(ids, friends):
+    # ``friends`` are the user-user graphs for the same users.
+    top = dict((id, _top(friends[id], 5)) for id in ids)
+    user_ids = list(set(u for values in top.values() for u, _ in values))
+    repos = dict(zip(user_ids, _zrevrange_many(
+        ["u:{0}:r".format(u) for u in user_ids], 8)))
+
+    candidates = []
+    for id in ids:
+        for user, user_score in top[id]:
+            for repo, repo_score in repos[user]:
+                candidates.append((id, repo, user_score + repo_score))
+
+    # Skip the repos that the user has already interacted with.
+    pipe = get_connection().pipeline(transaction=False)
+    for id, repo, _ in candidates:
+        pipe.zscore(format_key("u:{0}:r".format(id)), repo)
+    known = pipe.execute()
+
+    results = dict((id, defaultdict(float)) for id in ids)
+    for (id, repo, score), k in zip(candidates, known):
+        if k is None:
+            results[id][repo] += score
+    return results
+
+
+def repo_repo_graphs(ids):
+    users = _zrevrange_many(["r:{0}:u".format(id) for id in ids], 5)
+    user_ids = list(set(u for values in users for u, _ in values))
+    repos = dict(zip(user_ids, _zrevrange_many(
+        ["u:{0}:r".format(u) for u in user_ids], 5)))
+
+    results = dict()
+    for id, values in zip(ids, users):
+        scores = defaultdict(float)
+        for user, user_score in values:
+            for repo, repo_score in repos[user]:
+                if repo != id:
+                    scores[repo] += user_score + repo_score
+        results[id] = scores
+    return results
+
+
+def _jitter(ttl):
+    # Spread the expiry of graphs written together over a range of times.
+    jitter = flask.current_app.config["SOCIAL_GRAPH_JITTER"]
+    return max(1, int(ttl * random.uniform(1 - jitter, 1 + jitter)))
+
+
+def write_graphs(template, graphs, ttl):
+    """
+    Replace the graphs given as ``{id: {member: score}}`` and mark them as
+    fresh for about ``ttl`` seconds. Any locks on them are released.
+
+    """
+    stale_ttl = flask.current_app.config["SOCIAL_GRAPH_STALE_TTL"]
+    # Each graph is replaced inside a transaction so that readers never see
+    # a partially written key.
+    with get_connection().pipeline() as pipe:
+        for id, scores in graphs.items():
+            key = format_key(template.format(id))
+            fresh = _jitter(ttl)
+            pipe.delete(key)
+            if len(scores):
+                args = []
+                for member, score in scores.items():
+                    args += [score, member]
+                pipe.zadd(key, *args)
+                pipe.expire(key, fresh + stale_ttl)
+            pipe.set(key + ":f", 1, ex=fresh)
+            pipe.delete(key + ":l")
+        pipe.execute()
+
+
+def expire_graphs(template, ids):
+    """
+    Mark some graphs as stale so they are rebuilt on the next request.
+
+    """
+    keys = [format_key(template.format(id)) + ":f" for id in ids]
+    if len(keys):
+        get_connection().delete(*keys)
+
+
+def _gate(pipe, template, id, rebuild=True):
+    key = format_key(template.format(id))
+    lock_ttl = flask.current_app.config["SOCIAL_GRAPH_LOCK_TTL"]
+    scripts.call("graph_gate", [key, key + ":f", key + ":l"],
+                 [lock_ttl, int(rebuild)], client=pipe)
+
+
+def _walk():
+    # When the similarity engine owns the user-user and repo-repo graphs,
+    # they are only rebuilt offline and the requests serve the stored copy.
+    return flask.current_app.config["SOCIAL_GRAPH_SOURCE"] != "similarity"
+
+
+def _flatten(scores):
+    values = []
+    for member, score in _top(scores, 5):
+        values += [member, score]
+    return values
+
+
+def user_graphs(id):
+    """
+    Get the top of the friends (``s:u:{id}:u``) and repo recommendations
+    (``s:u:{id}:r``) graphs of a user as flat ``[id, score, ...]`` lists,
+    rebuilding them if they are stale and no other request is doing it.
+
+    """
+    return user_graphs_many([id])[str(id)]
+
+
+def user_graphs_many(ids, repos=True):
+    """
+    The same as :func:`user_graphs` for a list of users, gating all of the
+    graphs in one pipeline and rebuilding the stale ones together. Returns
+    a dictionary keyed by the ids as strings. If ``repos`` is false, the
+    repo recommendations are skipped and returned as ``None``.
+
+    """
+    ids = [str(id) for id in ids]
+    ttl = flask.current_app.config["SOCIAL_GRAPH_TTL"]
+    walk = _walk()
+    with get_connection().pipeline(transaction=False) as pipe:
+        for id in ids:
+            _gate(pipe, "s:u:{0}:u", id, rebuild=walk)
+            if repos:
+                _gate(pipe, "s:u:{0}:r", id)
+        results = scripts.execute(pipe)
+    step = 2 if repos else 1
+    friends = dict(zip(ids, (values for _, values in results[::step])))
+
+    build = [id for id, (b, _) in zip(ids, results[::step]) if b]
+    if len(build):
+        graphs = user_user_graphs(build)
+        write_graphs("s:u:{0}:u", graphs, ttl)
+        for id in build:
+            friends[id] = _flatten(graphs[id])
+
+    if not repos:
+        return dict((id, (friends[id], None)) for id in ids)
+    repos = dict(zip(ids, (values for _, values in results[1::2])))
+    build = [id for id, (b, _) in zip(ids, results[1::2]) if b]
+    if len(build):
+        scores = dict()
+        for id in build:
+            values = [m.decode("ascii") if isinstance(m, bytes) else m
+                      for m in friends[id][::2]]
+            scores[id] = dict(zip(values, map(float, friends[id][1::2])))
+        graphs = user_repo_graphs(build, scores)
+        write_graphs("s:u:{0}:r", graphs, ttl)
+        for id in build:
+            repos[id] = _flatten(graphs[id])
+    return dict((id, (friends[id], repos[id])) for id in ids)
+
+
+def repo_graphs(id):
+    """
+    Get the top of the similar repos graph (``s:r:{id}:r``) of a repo as a
+    flat ``[id, score, ...]`` list, rebuilding it if needed.
+
+    """
+    return repo_graphs_many([id])[str(id)]
+
+
+def repo_graphs_many(ids):
+    ids = [str(id) for id in ids]
+    walk = _walk()
+    with get_connection().pipeline(transaction=False) as pipe:
+        for id in ids:
+            _gate(pipe, "s:r:{0}:r", id, rebuild=walk)
+        results = scripts.execute(pipe)
+    repos = dict(zip(ids, (values for _, values in results)))
+    build = [id for id, (b, _) in zip(ids, results) if b]
+    if len(build):
+        graphs = repo_repo_graphs(build)
+        write_graphs("s:r:{0}:r", graphs,
+                     flask.current_app.config["SOCIAL_GRAPH_TTL"])
+        for id in build:
+            repos[id] = _flatten(graphs[id])
+    return repos
+
+
+def _pop(flag, count):
+    values = get_connection().execute_command("SPOP", _touched_key(flag),
+                                              count)
+    return [v.decode("ascii") for v in values]
+
+
+def refresh_graphs(batch=500):
+    """
+    Recompute the ``s:u:{id}:u``, ``s:u:{id}:r`` and ``s:r:{id}:r`` graphs
+    of every user and repo touched by the ingestion since the last call.
+    Returns the number of users and repos that were updated.
+
+    When ``SOCIAL_GRAPH_SOURCE`` is ``"similarity"``, the user-user and
+    repo-repo graphs are owned by :mod:`osrc.similarity` and only the repo
+    recommendations are rebuilt from the stored friends. The touched repos
+    are discarded.
+
+    """
+    config = flask.current_app.config
+    ttl = config["SOCIAL_GRAPH_TTL"]
+    walk = _walk()
+    nusers = nrepos = 0
+    while True:
+        ids = _pop("u", batch)
+        if not len(ids):
+            break
+        if walk:
+            friends = user_user_graphs(ids)
+            write_graphs("s:u:{0}:u", friends, ttl)
+        else:
+            friends = dict((id, dict(values)) for id, values in zip(
+                ids, _zrevrange_many(["s:u:{0}:u".format(id)
+                                      for id in ids], 4)))
+        write_graphs("s:u:{0}:r", user_repo_graphs(ids, friends), ttl)
+        nusers += len(ids)
+    while walk:
+        ids = _pop("r", batch)
+        if not len(ids):
+            break
+        write_graphs("s:r:{0}:r", repo_repo_graphs(ids), ttl)
+        nrepos += len(ids)
+    if not walk:
+        # The repo-repo graphs are rebuilt offline so the touched repos
+        # aren't needed.
+        get_connection().delete(_touched_key("r"))
+    return nusers, nrepos
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import redis
+
+__all__ = ["NSLOTS", "histogram_key", "bitfield_args", "decode_histogram",
+           "memory_usage"]
+
+# One unsigned 32-bit counter for each hour of the week, stored big-endian
+# in a Redis string so that BITFIELD can increment the slots in place.
+NSLOTS = 7 * 24
+DTYPE = np.dtype(">u4")
+
+
+def histogram_key(user_id, evt):
+    return "u:{0}:b:{1}".format(user_id, evt)
+
+
+def bitfield_args(counts):
+    """
+    The arguments of a ``BITFIELD`` command that adds a ``{slot: count}``
+    dictionary to a histogram, where ``slot`` is ``day * 24 + hour``. The
+    counters saturate instead of wrapping around.
+
+    """
+    args = ["OVERFLOW", "SAT"]
+    for slot, c in counts.items():
+        args += ["INCRBY", "u32", "#{0}".format(slot), c]
+    return args
+
+
+def decode_histogram(value):
+    """
+    Decode a histogram string into a ``(7, 24)`` array of counts by weekday
+    and hour. Missing keys decode to zeros.
+
+    """
+    hist = np.zeros(NSLOTS, dtype=np.int64)
+    if value:
+        counts = np.frombuffer(value, dtype=DTYPE,
+                               count=min(len(value) // DTYPE.itemsize,
+                                         NSLOTS))
+        hist[:len(counts)] = counts
+    return hist.reshape((7, 24))
+
+
+def memory_usage(conn, keys):
+    """
+    The number of bytes used by each key according to ``MEMORY USAGE``, or
+    ``None`` if the server doesn't support it (Redis < 4.0).
+
+    """
+    pipe = conn.pipeline(transaction=False)
+    for key in keys:
+        pipe.execute_command("MEMORY", "USAGE", key)
+    try:
+        return [int(v or 0) for v in pipe.execute()]
+    except redis.exceptions.ResponseError:
+        return None
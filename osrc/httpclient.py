@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import flask
+import requests
+import threading
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from .metrics import Metrics
+
+__all__ = ["RateLimited", "Client", "get_client"]
+
+
+class RateLimited(requests.exceptions.RequestException):
+
+    def __init__(self, reset):
+        self.reset = reset
+        super(RateLimited, self).__init__(
+            "rate limit budget exhausted until {0}".format(reset))
+
+
+class Client(object):
+    """
+    A keep-alive HTTP session with a bounded connection pool, a limit on the
+    number of concurrent requests and retries with exponential backoff.
+
+    The ``X-RateLimit-Remaining`` and ``X-RateLimit-Reset`` headers of the
+    responses are tracked and, once fewer than ``reserve`` requests are left,
+    :class:`RateLimited` is raised instead of making the request until the
+    limit resets.
+
+    """
+
+    def __init__(self, name, pool_size=10, max_concurrency=10, retries=3,
+                 backoff=0.5, timeout=10, reserve=0):
+        self.name = name
+        self.timeout = timeout
+        self.reserve = reserve
+
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=Retry(total=retries, backoff_factor=backoff,
+                              status_forcelist=[500, 502, 503, 504],
+                              raise_on_status=False),
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+
+        self.lock = threading.Lock()
+        self.remaining = None
+        self.reset = None
+        self.metrics = Metrics(client=name)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        self._spend_token()
+        kwargs["timeout"] = kwargs.get("timeout", self.timeout)
+        with self.semaphore:
+            try:
+                with self.metrics.timer("request"):
+                    r = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException:
+                self.metrics.incr("errors")
+                raise
+        self.metrics.incr("calls")
+        self.metrics.incr("status_{0}".format(r.status_code))
+        self._update_budget(r)
+        return r
+
+    def _spend_token(self):
+        with self.lock:
+            if self.remaining is None:
+                return
+            if self.reset <= time.time():
+                self.remaining = None
+                return
+            if self.remaining <= self.reserve:
+                self.metrics.incr("throttled")
+                raise RateLimited(self.reset)
+            self.remaining -= 1
+
+    def _update_budget(self, r):
+        remaining = r.headers.get("X-RateLimit-Remaining")
+        reset = r.headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        with self.lock:
+            self.remaining = int(remaining)
+            self.reset = int(reset)
+
+    def stats(self):
+        # The connection pools know how many connections they opened for
+        # how many requests so the difference is the number of reuses.
+        connections = nrequests = 0
+        for key in self.adapter.poolmanager.pools.keys():
+            pool = self.adapter.poolmanager.pools[key]
+            connections += pool.num_connections
+            nrequests += pool.num_requests
+        summary = self.metrics.summary()
+        summary["connections"] = connections
+        summary["reuse_rate"] = (1.0 - connections / nrequests
+                                 if nrequests else None)
+        summary["rate_limit_remaining"] = self.remaining
+        return summary
+
+
+_clients = dict()
+_clients_pid = None
+
+
+def get_client(name, reserve=0):
+    """
+    Get the shared client called ``name`` for the current process. Sessions
+    aren't shared across a fork so the clients are recreated in a new
+    process.
+
+    """
+    global _clients, _clients_pid
+    if _clients_pid != os.getpid():
+        _clients = dict()
+        _clients_pid = os.getpid()
+    if name not in _clients:
+        config = flask.current_app.config
+        _clients[name] = Client(
+            name,
+            pool_size=config["HTTP_POOL_SIZE"],
+            max_concurrency=config["HTTP_MAX_CONCURRENCY"],
+            retries=config["HTTP_RETRIES"],
+            backoff=config["HTTP_BACKOFF"],
+            timeout=config["HTTP_TIMEOUT"],
+            reserve=reserve,
+        )
+    return _clients[name]
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import flask
+from datetime import datetime, timedelta
+
+from . import google
+from .models import db, Location
+
+__all__ = ["normalize", "lookup", "resolve_locations"]
+
+# The SQL equivalent of `normalize`.
+normalize_sql = "lower(regexp_replace(trim({0}), '\\s+', ' ', 'g'))"
+
+
+def normalize(location):
+    return " ".join(location.lower().split())
+
+
+def lookup(location):
+    """
+    Get the cached geocoding result for a location string. Returns ``None``
+    if the location hasn't been resolved yet or if it couldn't be geocoded.
+
+    """
+    loc = Location.query.filter_by(name=normalize(location)).first()
+    if loc is None or not loc.found:
+        return None
+    return loc
+
+
+def resolve_locations(limit=None):
+    """
+    Geocode the distinct locations of the users without a timezone that
+    aren't in the cache yet (or whose failed lookup is older than
+    ``GEOCODE_NEGATIVE_TTL`` seconds) and then fill in the coordinates and
+    timezones of all of the users with a resolved location.
+
+    """
+    retry = datetime.utcnow() - timedelta(
+        seconds=flask.current_app.config["GEOCODE_NEGATIVE_TTL"])
+    query = """
+        SELECT DISTINCT {0} AS name FROM gh_users
+        LEFT OUTER JOIN gh_locations ON (gh_locations.name = {0})
+        WHERE gh_users.location IS NOT NULL
+          AND gh_users.timezone IS NULL
+          AND (gh_locations.name IS NULL
+               OR (NOT gh_locations.found AND gh_locations.updated < :retry))
+    """.format(normalize_sql.format("gh_users.location"))
+    if limit is not None:
+        query += " LIMIT {0:d}".format(limit)
+    names = [row[0] for row in db.session.execute(query, dict(retry=retry))
+             if len(row[0])]
+
+    count = 0
+    for name in names:
+        r = google.timezone(name)
+        loc = Location(name=name, found=r is not None,
+                       updated=datetime.utcnow())
+        if r is not None:
+            latlng, loc.timezone = r
+            loc.lat = latlng["lat"]
+            loc.lng = latlng["lng"]
+            count += 1
+        db.session.merge(loc)
+        db.session.commit()
+
+    db.session.execute("""
+        UPDATE gh_users
+        SET lat = gh_locations.lat,
+            lng = gh_locations.lng,
+            timezone = gh_locations.timezone
+        FROM gh_locations
+        WHERE gh_users.location IS NOT NULL
+          AND gh_users.timezone IS NULL
+          AND gh_locations.found
+          AND gh_locations.name = {0}
+    """.format(normalize_sql.format("gh_users.location")))
+    db.session.commit()
+    return len(names), count
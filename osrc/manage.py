@@ -1,15 +1,28 @@
 # -*- coding: utf-8 -*-
 
 import glob
+import json
+import time
 
 from flask_script import Command, Option
 
 from .models import db
 from .update import update
 from .redis import get_connection
+from .migrate import migrate_histograms
+from .locations import resolve_locations
+from .httpclient import RateLimited
+from .github import github_client, drain_refresh_queue
+from .benchmark import run_benchmark, parse_mix
+from .social import prune_social
+from .buckets import compact_buckets
+from .similarity import update_similarities
 
 __all__ = [
     "CreateTablesCommand", "DropTablesCommand", "UpdateCommand",
+    "MigrateHistogramsCommand", "BenchmarkCommand", "RefreshCommand",
+    "GeocodeCommand", "SimilarityCommand", "PruneSocialCommand",
+    "CompactCommand",
 ]
 
 
@@ -29,10 +42,132 @@ class UpdateCommand(Command):
     option_list = (
         Option("-s", "--since", dest="since", required=False),
         Option("-p", "--pattern", dest="pattern", required=False),
+        Option("-m", "--metrics", dest="metrics_file", required=False),
     )
 
-    def run(self, since, pattern):
+    def run(self, since, pattern, metrics_file):
         files = None
         if pattern is not None:
             files = glob.glob(pattern)
-        update(files=files, since=since)
+        update(files=files, since=since, metrics_file=metrics_file)
+
+
+class MigrateHistogramsCommand(Command):
+
+    option_list = (
+        Option("-n", "--batch", dest="batch", type=int, default=1000),
+        Option("--sample", dest="sample", type=int, default=100),
+    )
+
+    def run(self, batch, sample):
+        count, sizes = migrate_histograms(batch=batch, sample=sample)
+        print("migrated {0} histograms".format(count))
+        if sizes is not None:
+            before = sizes["before"] / sizes["samples"]
+            after = sizes["after"] / sizes["samples"]
+            print("sampled {0} histograms: {1:.0f} -> {2:.0f} bytes each, "
+                  "about {3:.1f} MB saved in total".format(
+                      sizes["samples"], before, after,
+                      (before - after) * count / 1024 ** 2))
+
+
+class BenchmarkCommand(Command):
+
+    option_list = (
+        Option("--files", dest="nfiles", type=int, default=1),
+        Option("-n", "--events", dest="nevents", type=int, default=100000),
+        Option("--users", dest="nusers", type=int, default=20000),
+        Option("--repos", dest="nrepos", type=int, default=50000),
+        Option("--skew", dest="skew", type=float, default=1.1),
+        Option("--mix", dest="mix", required=False),
+        Option("--seed", dest="seed", type=int, default=None),
+        Option("--skip-db", dest="skip_db", action="store_true"),
+        Option("--trace-memory", dest="trace_memory", action="store_true"),
+        Option("-d", "--directory", dest="directory", required=False),
+    )
+
+    def run(self, mix, **kwargs):
+        results = run_benchmark(mix=parse_mix(mix), **kwargs)
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+class RefreshCommand(Command):
+
+    option_list = (
+        Option("-n", "--batch", dest="batch", type=int, default=100),
+        Option("-s", "--sleep", dest="sleep", type=float, default=5.0),
+        Option("--once", dest="once", action="store_true"),
+    )
+
+    def run(self, batch, sleep, once):
+        while True:
+            try:
+                count = drain_refresh_queue(limit=batch)
+            except RateLimited as e:
+                print("rate limited until {0}".format(e.reset))
+                if once:
+                    break
+                time.sleep(max(e.reset - time.time(), sleep))
+                continue
+            if count:
+                print("refreshed {0} entities".format(count))
+                print(json.dumps(github_client().stats(), sort_keys=True))
+            elif once:
+                break
+            else:
+                time.sleep(sleep)
+
+
+class GeocodeCommand(Command):
+
+    option_list = (
+        Option("-n", "--limit", dest="limit", type=int, required=False),
+    )
+
+    def run(self, limit):
+        total, found = resolve_locations(limit=limit)
+        print("geocoded {0} of {1} locations".format(found, total))
+
+
+class SimilarityCommand(Command):
+
+    option_list = (
+        Option("-d", "--directory", dest="directory", required=True),
+        Option("-k", dest="k", type=int, default=10),
+        Option("--metric", dest="metric", choices=["cosine", "jaccard"],
+               default="cosine"),
+        Option("--block", dest="block", type=int, default=1000),
+        Option("-p", "--processes", dest="processes", type=int,
+               required=False),
+        Option("--skip-export", dest="export", action="store_false"),
+    )
+
+    def run(self, **kwargs):
+        nusers, nrepos = update_similarities(**kwargs)
+        print("stored similarities for {0} users and {1} repos"
+              .format(nusers, nrepos))
+
+
+class PruneSocialCommand(Command):
+
+    option_list = (
+        Option("-c", "--cap", dest="cap", type=int, required=False),
+        Option("-n", "--batch", dest="batch", type=int, default=1000),
+    )
+
+    def run(self, cap, batch):
+        nkeys, nremoved = prune_social(cap=cap, batch=batch)
+        print("removed {0} members from {1} zsets".format(nremoved, nkeys))
+
+
+class CompactCommand(Command):
+
+    option_list = (
+        Option("-r", "--retention", dest="retention", type=int,
+               required=False),
+        Option("-n", "--batch", dest="batch", type=int, default=1000),
+    )
+
+    def run(self, retention, batch):
+        count = compact_buckets(retention=retention, batch=batch)
+        print("compacted {0} buckets".format(count))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import time
+from contextlib import contextmanager
+from collections import defaultdict
+
+__all__ = ["Metrics"]
+
+
+class Metrics(object):
+    """
+    Accumulates the time spent in named stages and a set of named counters.
+    Summaries from several instances (for example, one per worker process)
+    can be combined using :func:`Metrics.merge`.
+
+    """
+
+    def __init__(self, **labels):
+        self.labels = labels
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    @contextmanager
+    def timer(self, stage):
+        strt = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.perf_counter() - strt
+
+    def add_time(self, stage, seconds):
+        self.seconds[stage] += seconds
+
+    def incr(self, name, amount=1):
+        self.counts[name] += amount
+
+    def merge(self, summary):
+        for k, v in summary["seconds"].items():
+            self.seconds[k] += v
+        for k, v in summary["counts"].items():
+            self.counts[k] += v
+
+    def summary(self):
+        return dict(
+            self.labels,
+            seconds=dict(self.seconds),
+            counts=dict(self.counts),
+        )
+
+    def prometheus(self, namespace):
+        """
+        Render the metrics in the Prometheus text exposition format.
+
+        """
+        lines = [
+            "# HELP {0}_stage_seconds_total Time spent in each stage."
+            .format(namespace),
+            "# TYPE {0}_stage_seconds_total counter".format(namespace),
+        ]
+        for k, v in sorted(self.seconds.items()):
+            lines.append("{0}_stage_seconds_total{{stage=\"{1}\"}} {2!r}"
+                         .format(namespace, k, v))
+        for k, v in sorted(self.counts.items()):
+            lines.append("# TYPE {0}_{1}_total counter".format(namespace, k))
+            lines.append("{0}_{1}_total {2}".format(namespace, k, v))
+        return "\n".join(lines) + "\n"
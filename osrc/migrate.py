@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import flask
+
+from .redis import get_connection, get_pipeline, format_key
+from .histogram import histogram_key, bitfield_args, memory_usage
+
+__all__ = ["migrate_histograms"]
+
+
+def _legacy_counts(hist):
+    # One comma separated string of 24 counts per weekday.
+    counts = dict()
+    for day, values in hist.items():
+        day = int(day)
+        values = map(int, values.decode("ascii").split(","))
+        for hour, c in enumerate(values):
+            if c:
+                counts[day * 24 + hour] = c
+    return counts
+
+
+def _hash_counts(hist):
+    # One counter per ``day * 24 + hour`` field.
+    return dict((int(slot), int(c)) for slot, c in hist.items() if int(c))
+
+
+def migrate_histograms(batch=1000, sample=100):
+    """
+    Convert the legacy ``u:{id}:e:{evt}`` histograms (one comma separated
+    string of 24 counts per weekday) and the ``u:{id}:h:{evt}`` hashes (one
+    counter per ``day * 24 + hour`` field) into the ``u:{id}:b:{evt}``
+    binary histograms.
+
+    The memory used by the first ``sample`` histograms in each batch is
+    measured with ``MEMORY USAGE`` before and after the conversion. Returns
+    the number of converted histograms and the sampled sizes in bytes (or
+    ``None`` if the server can't report them).
+
+    """
+    prefix = format_key("")
+    ttl = flask.current_app.config["REDIS_DEFAULT_TTL"]
+    conn = get_connection()
+    count = 0
+    sizes = dict(before=0, after=0, samples=0, supported=True)
+    for pattern, parse in [("u:*:e:*", _legacy_counts),
+                           ("u:*:h:*", _hash_counts)]:
+        keys = []
+        for key in conn.scan_iter(match=format_key(pattern), count=batch):
+            key = key.decode("ascii")
+            if len(key[len(prefix):].split(":")) != 4:
+                continue
+            keys.append(key)
+            if len(keys) >= batch:
+                count += _migrate_batch(conn, keys, prefix, parse, ttl,
+                                        sample, sizes)
+                keys = []
+        if len(keys):
+            count += _migrate_batch(conn, keys, prefix, parse, ttl, sample,
+                                    sizes)
+    if not sizes.pop("supported") or not sizes["samples"]:
+        sizes = None
+    return count, sizes
+
+
+def _migrate_batch(conn, keys, prefix, parse, ttl, sample, sizes):
+    new_keys = []
+    for key in keys:
+        _, user_id, _, evt = key[len(prefix):].split(":")
+        new_keys.append(format_key(histogram_key(user_id, evt)))
+
+    # Only sample the histograms that don't have a binary copy yet since
+    # its size would include counts that aren't in the old key.
+    before = sampled = None
+    if sizes["supported"] and sample > 0:
+        with conn.pipeline(transaction=False) as pipe:
+            for key in new_keys:
+                pipe.exists(key)
+            exists = pipe.execute()
+        sampled = [(k, n) for k, n, e in zip(keys, new_keys, exists)
+                   if not e][:sample]
+        if len(sampled):
+            before = memory_usage(conn, [k for k, _ in sampled])
+            sizes["supported"] = before is not None
+
+    with get_pipeline() as pipe:
+        for key in keys:
+            pipe.hgetall(key)
+        hists = pipe.execute()
+
+        for key, new_key, hist in zip(keys, new_keys, hists):
+            counts = parse(hist)
+            if len(counts):
+                pipe.execute_command("BITFIELD", new_key,
+                                     *bitfield_args(counts))
+                pipe.expire(new_key, ttl)
+            pipe.delete(key)
+        pipe.execute()
+
+    if before is not None:
+        after = memory_usage(conn, [n for _, n in sampled])
+        sizes["before"] += sum(before)
+        sizes["after"] += sum(after)
+        sizes["samples"] += len(sampled)
+    return len(keys)
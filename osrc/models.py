@@ -2,9 +2,9 @@
 
 from flask_sqlalchemy import SQLAlchemy
 
-from .utils import load_json_resource
+from .utils import load_optouts
 
-__all__ = ["db", "User", "Repo"]
+__all__ = ["db", "User", "Repo", "Location"]
 
 
 db = SQLAlchemy()
@@ -32,8 +32,7 @@ class User(db.Model):
     def is_active(self):
         if not self.active:
             return False
-        names = load_json_resource("optout.json")
-        return not (self.login.lower() in names)
+        return self.login.lower() not in load_optouts()
 
     @property
     def render_name(self):
@@ -112,6 +111,19 @@ class Repo(db.Model):
             issues=self.issues_count,
         )
 
+
+class Location(db.Model):
+    __tablename__ = "gh_locations"
+    # The normalized location string; see `osrc.locations.normalize`.
+    name = db.Column(db.Text, primary_key=True)
+    lat = db.Column(db.Float)
+    lng = db.Column(db.Float)
+    timezone = db.Column(db.Integer)
+    # False if the location couldn't be geocoded.
+    found = db.Column(db.Boolean)
+    updated = db.Column(db.DateTime)
+
+
 db.Index("ix_gh_users_login_lower",
          db.func.lower(db.metadata.tables["gh_users"].c.login))
 db.Index("ix_gh_repos_fullaname_lower",
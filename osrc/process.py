@@ -2,8 +2,8 @@
 
 from datetime import datetime
 
-from . import google
-from .utils import load_json_resource
+from . import locations
+from .utils import load_optouts
 from .models import db, User, Repo
 
 __all__ = [
@@ -77,7 +77,7 @@ def process_user(user, etag=None):
     update_tz = True
     if user_obj is None:
         # Make sure that users who opted out previously have active=False.
-        optouts = load_json_resource("optout.json")
+        optouts = load_optouts()
 
         user_obj = User(
             id=user["id"],
@@ -102,13 +102,13 @@ def process_user(user, etag=None):
         if etag is not None:
             user_obj.etag = etag
 
-    # Update the timezone.
+    # Update the timezone from the shared location cache. Locations that
+    # aren't in the cache yet are geocoded offline by `resolve_locations`,
+    # which picks up any user without a timezone.
     if update_tz and user_obj.location is not None:
-        r = google.timezone(user_obj.location)
-        if r is not None:
-            latlng, tz = r
-            user_obj.timezone = tz
-            user_obj.lat = latlng["lat"]
-            user_obj.lng = latlng["lng"]
+        loc = locations.lookup(user_obj.location)
+        user_obj.timezone = None if loc is None else loc.timezone
+        user_obj.lat = None if loc is None else loc.lat
+        user_obj.lng = None if loc is None else loc.lng
 
     return user_obj
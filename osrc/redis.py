@@ -5,7 +5,8 @@ from __future__ import division, print_function
 import flask
 import redis
 
-__all__ = ["get_connection", "get_pipeline", "format_key"]
+__all__ = ["get_connection", "get_pipeline", "format_key",
+           "reset_connection_pool"]
 
 redis_pool = None
 
@@ -16,6 +17,10 @@ def get_connection():
         redis_pool = redis.ConnectionPool().from_url(url)
     return redis.StrictRedis(connection_pool=redis_pool)
 
+def reset_connection_pool(pool=None):
+    global redis_pool
+    redis_pool = pool
+
 def get_pipeline():
     r = get_connection()
     return r.pipeline()
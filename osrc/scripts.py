@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+from redis.exceptions import NoScriptError
+
+from .redis import get_connection
+from .utils import DATA_DIR, load_text_resource
+
+__all__ = ["ScriptRegistry", "scripts"]
+
+
+class ScriptRegistry(object):
+    """
+    The Lua scripts in ``osrc/data``, called by SHA with ``EVALSHA``.
+
+    The SHAs are computed locally so the scripts can be queued on any
+    pipeline without checking the server first. :func:`load` sends them all
+    with ``SCRIPT LOAD`` and is called again when a call fails with
+    ``NOSCRIPT`` (e.g. after Redis was restarted or flushed).
+
+    """
+
+    def __init__(self, base=DATA_DIR):
+        self.base = base
+        self.shas = dict()
+
+    def names(self):
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(self.base)
+                      if f.endswith(".lua"))
+
+    def sha(self, name):
+        # The text is cached by the resource registry and only changes if it
+        # is reloaded so it's only hashed again then.
+        text = load_text_resource(name + ".lua", base=self.base)
+        entry = self.shas.get(name)
+        if entry is None or entry[0] is not text:
+            entry = self.shas[name] = (
+                text, hashlib.sha1(text.encode("utf-8")).hexdigest())
+        return entry[1]
+
+    def load(self, conn=None):
+        if conn is None:
+            conn = get_connection()
+        with conn.pipeline(transaction=False) as pipe:
+            for name in self.names():
+                self.sha(name)
+                pipe.script_load(self.shas[name][0])
+            pipe.execute()
+
+    def call(self, name, keys=[], args=[], client=None):
+        """
+        Call the script ``name``. If ``client`` is a pipeline, the call is
+        only queued and the pipeline must be run with :func:`execute`.
+
+        """
+        sha = self.sha(name)
+        if client is None:
+            client = get_connection()
+            try:
+                return client.evalsha(sha, len(keys), *(keys + args))
+            except NoScriptError:
+                self.load(client)
+        return client.evalsha(sha, len(keys), *(keys + args))
+
+    def execute(self, pipe):
+        """
+        Execute a pipeline that includes script calls. The calls that fail
+        with ``NOSCRIPT`` are run again, on their own, once the scripts are
+        loaded. The other commands of the pipeline have already run by then
+        so they aren't repeated, but in a transaction the repeated calls
+        aren't atomic with the rest of it.
+
+        """
+        stack = list(pipe.command_stack)
+        results = pipe.execute(raise_on_error=False)
+        retry = [i for i, r in enumerate(results)
+                 if isinstance(r, NoScriptError)]
+        if len(retry):
+            conn = get_connection()
+            self.load(conn)
+            with conn.pipeline(transaction=False) as p:
+                for i in retry:
+                    args, options = stack[i]
+                    p.execute_command(*args, **options)
+                for i, r in zip(retry, p.execute(raise_on_error=False)):
+                    results[i] = r
+        for r in results:
+            if isinstance(r, Exception):
+                raise r
+        return results
+
+
+scripts = ScriptRegistry()
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+import os
+import flask
+import numpy as np
+from array import array
+from multiprocessing import Pool
+from scipy.sparse import csr_matrix
+from numpy.lib.format import open_memmap
+
+from .redis import get_connection, format_key
+from .graphs import write_graphs, expire_graphs
+
+__all__ = ["export_interactions", "load_matrix", "top_k_similar",
+           "store_similarities", "update_similarities"]
+
+
+def _path(directory, name, part):
+    return os.path.join(directory, "{0}_{1}.npy".format(name, part))
+
+
+def save_matrix(directory, name, matrix):
+    for part in ("data", "indices", "indptr"):
+        np.save(_path(directory, name, part), getattr(matrix, part))
+    np.save(_path(directory, name, "shape"), np.array(matrix.shape))
+
+
+def load_matrix(directory, name):
+    """
+    Load a CSR matrix saved by :func:`export_interactions`. The arrays are
+    memory-mapped so the matrix can be shared between processes.
+
+    """
+    parts = [np.load(_path(directory, name, part), mmap_mode="r")
+             for part in ("data", "indices", "indptr")]
+    shape = tuple(np.load(_path(directory, name, "shape")))
+    return csr_matrix(tuple(parts), shape=shape, copy=False)
+
+
+def export_interactions(directory, batch=1000, blocksize=2**22):
+    """
+    Export the ``u:{id}:r`` interaction counts into a users by repos CSR
+    matrix (``user_repo``) and its transpose (``repo_user``), along with the
+    ids of the rows (``users.npy``) and columns (``repos.npy``).
+
+    The rows are streamed to disk while scanning Redis so only the final
+    transpose needs the whole matrix in memory.
+
+    """
+    prefix = format_key("")
+    conn = get_connection()
+    users = array("l")
+    indptr = array("q", [0])
+    raw_indices = os.path.join(directory, "indices.raw")
+    raw_data = os.path.join(directory, "data.raw")
+
+    def flush(keys, fi, fd):
+        pipe = conn.pipeline(transaction=False)
+        for _, key in keys:
+            pipe.zrange(key, 0, -1, withscores=True)
+        for (user, _), values in zip(keys, pipe.execute()):
+            if not len(values):
+                continue
+            fi.write(np.array([int(m) for m, _ in values],
+                              dtype=np.int32).tobytes())
+            fd.write(np.array([s for _, s in values],
+                              dtype=np.float32).tobytes())
+            users.append(user)
+            indptr.append(indptr[-1] + len(values))
+
+    with open(raw_indices, "wb") as fi, open(raw_data, "wb") as fd:
+        keys = []
+        for key in conn.scan_iter(match=format_key("u:*:r"), count=batch):
+            parts = key.decode("ascii")[len(prefix):].split(":")
+            if len(parts) != 3:
+                continue
+            keys.append((int(parts[1]), key))
+            if len(keys) >= batch:
+                flush(keys, fi, fd)
+                keys = []
+        if len(keys):
+            flush(keys, fi, fd)
+
+    # Map the repo ids to column indices.
+    nnz = indptr[-1]
+    ids = np.memmap(raw_indices, dtype=np.int32, mode="r", shape=(nnz, ))
+    values = np.memmap(raw_data, dtype=np.float32, mode="r", shape=(nnz, ))
+    repos = np.unique(ids)
+    indices = open_memmap(_path(directory, "user_repo", "indices"),
+                          mode="w+", dtype=np.int32, shape=(nnz, ))
+    data = open_memmap(_path(directory, "user_repo", "data"),
+                       mode="w+", dtype=np.float32, shape=(nnz, ))
+    for i in range(0, nnz, blocksize):
+        indices[i:i+blocksize] = np.searchsorted(repos, ids[i:i+blocksize])
+        data[i:i+blocksize] = values[i:i+blocksize]
+    indices.flush()
+    data.flush()
+    del ids, values, indices, data
+    os.remove(raw_indices)
+    os.remove(raw_data)
+
+    indptr = np.frombuffer(indptr, dtype=np.int64)
+    np.save(_path(directory, "user_repo", "indptr"), indptr)
+    np.save(_path(directory, "user_repo", "shape"),
+            np.array([len(users), len(repos)]))
+    np.save(os.path.join(directory, "users.npy"),
+            np.array(users, dtype=np.int64))
+    np.save(os.path.join(directory, "repos.npy"), repos)
+
+    save_matrix(directory, "repo_user",
+                load_matrix(directory, "user_repo").T.tocsr())
+    return len(users), len(repos), nnz
+
+
+# The state of each similarity worker; see `_init_worker`.
+_worker = None
+
+
+def _init_worker(directory, name, other, metric, k, block):
+    global _worker
+    a = load_matrix(directory, name)
+    b = load_matrix(directory, other)
+    if metric == "jaccard":
+        a = csr_matrix((np.ones(len(a.data), dtype=np.float32), a.indices,
+                        a.indptr), shape=a.shape)
+        b = csr_matrix((np.ones(len(b.data), dtype=np.float32), b.indices,
+                        b.indptr), shape=b.shape)
+        norms = np.diff(a.indptr).astype(np.float32)
+    else:
+        norms = np.sqrt(np.asarray(a.multiply(a).sum(axis=1)).ravel())
+    _worker = (a, b, norms, metric, k, block)
+
+
+def _similar_block(start):
+    a, b, norms, metric, k, block = _worker
+    stop = min(start + block, a.shape[0])
+    s = a[start:stop].dot(b).tocsr()
+
+    neighbors = np.empty((stop - start, k), dtype=np.int64)
+    neighbors[:] = -1
+    scores = np.zeros((stop - start, k), dtype=np.float32)
+    for i in range(stop - start):
+        lo, hi = s.indptr[i], s.indptr[i+1]
+        cols, vals = s.indices[lo:hi], s.data[lo:hi]
+        if metric == "jaccard":
+            vals = vals / (norms[start+i] + norms[cols] - vals)
+        else:
+            vals = vals / (norms[start+i] * norms[cols])
+        m = cols != start + i
+        cols, vals = cols[m], vals[m]
+        if len(vals) > k:
+            top = np.argpartition(-vals, k)[:k]
+            cols, vals = cols[top], vals[top]
+        order = np.argsort(-vals)
+        neighbors[i, :len(order)] = cols[order]
+        scores[i, :len(order)] = vals[order]
+    return start, neighbors, scores
+
+
+def top_k_similar(directory, name, other, k=10, metric="cosine",
+                  block=1000, processes=None):
+    """
+    Compute the ``k`` most similar rows for every row of the matrix
+    ``name`` by multiplying blocks of rows by the matrix ``other`` (its
+    transpose) in a pool of processes. ``metric`` can be ``"cosine"`` or
+    ``"jaccard"``. Returns the indices of the neighbors (``-1`` for missing
+    entries) and their scores.
+
+    """
+    shape = tuple(np.load(_path(directory, name, "shape")))
+    neighbors = np.empty((shape[0], k), dtype=np.int64)
+    scores = np.empty((shape[0], k), dtype=np.float32)
+    pool = Pool(processes, initializer=_init_worker,
+                initargs=(directory, name, other, metric, k, block))
+    try:
+        for start, n, s in pool.imap_unordered(
+                _similar_block, range(0, shape[0], block)):
+            neighbors[start:start+len(n)] = n
+            scores[start:start+len(s)] = s
+    finally:
+        pool.close()
+        pool.join()
+    return neighbors, scores
+
+
+def store_similarities(template, ids, neighbors, scores, ttl, clear=None,
+                       batch=1000):
+    """
+    Write the neighbors of each entity into the graph given by ``template``
+    (``"s:u:{0}:u"`` or ``"s:r:{0}:r"``). The graphs given by the ``clear``
+    template are marked as stale since they depend on the new ones.
+
+    """
+    for i in range(0, len(ids), batch):
+        graphs = dict()
+        for j in range(i, min(i + batch, len(ids))):
+            graph = graphs[int(ids[j])] = dict()
+            for n, s in zip(neighbors[j], scores[j]):
+                if n < 0 or s <= 0:
+                    break
+                graph[int(ids[n])] = float(s)
+        write_graphs(template, graphs, ttl)
+        if clear is not None:
+            expire_graphs(clear, graphs.keys())
+
+
+def update_similarities(directory, k=10, metric="cosine", block=1000,
+                        processes=None, export=True):
+    """
+    Export the interaction matrix to ``directory``, compute the top ``k``
+    user-user and repo-repo similarities and store them as the social
+    graphs used by the stats pages.
+
+    """
+    if export:
+        export_interactions(directory)
+    ttl = flask.current_app.config["SIMILARITY_TTL"]
+
+    users = np.load(os.path.join(directory, "users.npy"))
+    neighbors, scores = top_k_similar(directory, "user_repo", "repo_user",
+                                      k=k, metric=metric, block=block,
+                                      processes=processes)
+    # The repo recommendations are built from the friends so they have to
+    # be rebuilt.
+    store_similarities("s:u:{0}:u", users, neighbors, scores, ttl,
+                       clear="s:u:{0}:r")
+
+    repos = np.load(os.path.join(directory, "repos.npy"))
+    neighbors, scores = top_k_similar(directory, "repo_user", "user_repo",
+                                      k=k, metric=metric, block=block,
+                                      processes=processes)
+    store_similarities("s:r:{0}:r", repos, neighbors, scores, ttl)
+    return len(users), len(repos)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import flask
+
+from .scripts import scripts
+from .redis import get_connection, format_key
+
+__all__ = ["floor_key", "capped_zincrby", "prune_social"]
+
+
+def floor_key(key):
+    return key + ":floor"
+
+
+def capped_zincrby(pipe, key, counts, cap, ttl=0):
+    """
+    Queue the increments in the ``{member: amount}`` dictionary ``counts``
+    for the social zset ``key`` (already formatted) on ``pipe`` and then
+    trim the zset to its ``cap`` highest members. See ``cap_zset.lua``. The
+    pipeline must be run with :func:`osrc.scripts.ScriptRegistry.execute`.
+
+    """
+    args = [cap, ttl]
+    for member, amount in counts.items():
+        args += [member, amount]
+    scripts.call("cap_zset", [key, floor_key(key)], args, client=pipe)
+
+
+def prune_social(cap=None, batch=1000):
+    """
+    Trim every ``u:{id}:r`` and ``r:{id}:u`` zset to the ``cap`` (default:
+    ``SOCIAL_ZSET_CAP``) highest members. The keys are scanned incrementally
+    so this can run against a live server. Returns the number of keys that
+    were checked and the number of members that were removed. Nothing is
+    trimmed if ``SOCIAL_ZSET_CAP`` is ``None`` (uncapped).
+
+    """
+    if cap is None:
+        cap = flask.current_app.config["SOCIAL_ZSET_CAP"]
+    if cap is None:
+        return 0, 0
+    prefix = format_key("")
+    conn = get_connection()
+    nkeys = nremoved = 0
+    for pattern in ["u:*:r", "r:*:u"]:
+        keys = []
+        for key in conn.scan_iter(match=format_key(pattern), count=batch):
+            key = key.decode("ascii")
+            if len(key[len(prefix):].split(":")) != 3:
+                continue
+            keys.append(key)
+            if len(keys) >= batch:
+                nremoved += _prune_batch(conn, keys, cap)
+                nkeys += len(keys)
+                keys = []
+        if len(keys):
+            nremoved += _prune_batch(conn, keys, cap)
+            nkeys += len(keys)
+    return nkeys, nremoved
+
+
+def _prune_batch(conn, keys, cap):
+    with conn.pipeline(transaction=False) as pipe:
+        for key in keys:
+            capped_zincrby(pipe, key, {}, cap)
+        return sum(scripts.execute(pipe))
@@ -1,90 +1,195 @@
 # -*- coding: utf-8 -*-
 
-import flask
 import operator
 from math import sqrt
 from collections import defaultdict
 
 from . import github
-from .models import User, Repo
-from .utils import load_json_resource, load_text_resource
-from .redis import get_pipeline, get_connection, format_key
+from .cache import Payload, get_cached, get_cached_many
+from .graphs import user_graphs_many, repo_graphs_many
+from .distinct import distinct_counts_many
+from .buckets import window_keys, merged_zsets
+from .histogram import histogram_key, decode_histogram
+from .utils import load_json_resource, load_days
+from .redis import get_pipeline, format_key
 
-__all__ = ["user_stats", "repo_stats"]
+__all__ = ["USER_FIELDS", "REPO_FIELDS", "user_stats", "repo_stats",
+           "user_payload", "repo_payload", "user_payloads", "repo_payloads"]
 
+# The sections of the stats that can be requested on their own. The basic
+# details of the user or repo are always included.
+USER_FIELDS = ("descriptions", "total", "events", "week", "day", "languages",
+               "repos", "distinct_repos", "friends", "repo_recs")
+REPO_FIELDS = ("interactions", "contributors", "repo_recs", "total",
+               "events")
 
-def user_stats(username, tz_offset=True):
+
+def user_stats(username, tz_offset=True, window=None, fields=None):
+    payload = user_payload(username, tz_offset=tz_offset, window=window,
+                           fields=fields)
+    if not payload:
+        return payload
+    return payload.data
+
+
+def user_payload(username, tz_offset=True, compressed=False, window=None,
+                 fields=None):
     user = github.get_user(username)
     if user is None:
         return None
     if not user.is_active:
         return False
+    fields = _fields(fields, USER_FIELDS)
+    if not tz_offset:
+        return Payload.from_data(
+            compute_user_stats(user, tz_offset=False, window=window,
+                               fields=fields),
+            compress=compressed)
+    return get_cached("u", user.id,
+                      lambda: compute_user_stats(user, window=window,
+                                                 fields=fields),
+                      compressed=compressed,
+                      variant=_variant(window, fields, USER_FIELDS))
+
+
+def user_payloads(usernames, compressed=False, window=None, fields=None):
+    """
+    Get the stats payloads for a list of logins with one database query and
+    a few Redis pipelines for all of them. Returns a dictionary keyed by
+    login with the same ``None`` (unknown) and ``False`` (opted out) values
+    as :func:`user_payload`.
+
+    """
+    fields = _fields(fields, USER_FIELDS)
+    users = github.get_users_by_login(usernames)
+    results = dict()
+    active = dict()
+    for name in usernames:
+        user = users.get(name.lower())
+        if user is None:
+            results[name] = None
+        elif not user.is_active:
+            results[name] = False
+        else:
+            active[user.id] = user
+
+    def compute(ids):
+        stats = compute_user_stats_many([active[id] for id in ids],
+                                        window=window, fields=fields)
+        return dict(zip(ids, stats))
+
+    payloads = get_cached_many("u", list(active.keys()), compute,
+                               compressed=compressed,
+                               variant=_variant(window, fields, USER_FIELDS))
+    for name in usernames:
+        if name not in results:
+            results[name] = payloads[users[name.lower()].id]
+    return results
+
+
+def compute_user_stats(user, tz_offset=True, window=None, fields=None):
+    return compute_user_stats_many([user], tz_offset=tz_offset,
+                                   window=window, fields=fields)[0]
+
+
+def compute_user_stats_many(users, tz_offset=True, window=None, fields=None):
+    # If ``window`` is given, the counts only include the events of the last
+    # ``window`` months. The social graphs always cover all of them. The
+    # Redis reads for all of the users are batched into a few pipelines and
+    # only the sections needed for ``fields`` are read.
+    fields = _fields(fields, USER_FIELDS)
+    ids = [user.id for user in users]
+    none = [[] for _ in ids]
 
     #
-    # REPOS:
+    # REPOS AND EVENT COUNTS:
     #
-    conn = get_connection()
-    repos = conn.zrevrange(format_key("u:{0}:r".format(user.id)), 0, 4,
-                           withscores=True)
+    # The events include the schedule counts and the descriptions are built
+    # from the languages and the schedule.
+    want_repos = bool(fields & {"repos", "languages", "descriptions"})
+    want_events = bool(fields & {"events", "total", "week", "day",
+                                 "descriptions"})
+    keys = []
+    if want_repos:
+        keys += _counter_keys(["u:{0}:r".format(id) for id in ids], window)
+    if want_events:
+        keys += _counter_keys(["u:{0}:e".format(id) for id in ids], window)
+    with get_pipeline() as pipe:
+        for key in keys:
+            pipe.zrevrange(key, 0, 4, withscores=True)
+        results = pipe.execute() if len(keys) else []
+    repos = events = none
+    if want_repos:
+        repos = [[(int(r), int(c)) for r, c in values]
+                 for values in results[:len(ids)]]
+        results = results[len(ids):]
+    if want_events:
+        events = [[(k.decode("ascii"), c) for k, c in values]
+                  for values in results]
+
+    #
+    # SCHEDULE:
+    #
+    with get_pipeline() as pipe:
+        for id, keys in zip(ids, events):
+            for k, _ in keys:
+                key = histogram_key(id, k)
+                pipe.mget([format_key(key)] if window is None
+                          else window_keys(key, window))
+        hists = iter(pipe.execute() if want_events else [])
+    schedules = [dict((k, sum(map(decode_histogram, next(hists))))
+                      for k, _ in keys) for keys in events]
+
+    #
+    # FRIENDS AND SIMILAR REPOS:
+    #
+    graphs = [([], [])] * len(ids)
+    if fields & {"friends", "repo_recs"}:
+        graphs = user_graphs_many(ids, repos="repo_recs" in fields)
+        graphs = [(graphs[str(id)][0], graphs[str(id)][1] or [])
+                  for id in ids]
+    distinct = [None] * len(ids)
+    if "distinct_repos" in fields:
+        distinct = distinct_counts_many("u", ids)
+
+    # Load all of the users and repos that are mentioned at once.
+    repo_objs = github.get_repos(set(
+        [r for values in repos for r, _ in values] +
+        [int(r) for _, recs in graphs for r in recs[::2]]))
+    user_objs = github.get_users(set(
+        int(u) for friends, _ in graphs for u in friends[::2]))
+
+    return [
+        _user_dict(user, repo_counts, schedule, event_counts,
+                   _hydrate(user_objs, friends), _hydrate(repo_objs, recs),
+                   counts, repo_objs, tz_offset, fields)
+        for user, repo_counts, schedule, event_counts, (friends, recs), counts
+        in zip(users, repos, schedules, events, graphs, distinct)
+    ]
+
+
+def _user_dict(user, repos, schedule, events, friends, repo_recs, distinct,
+               repo_objs, tz_offset, fields):
     repo_counts = []
     languages = defaultdict(int)
     for repo_id, count in repos:
-        r = github.get_repo(id=int(repo_id))
+        r = repo_objs.get(repo_id)
         if r is None:
             continue
-        repo_counts.append((r, int(count)))
+        repo_counts.append((r, count))
         if r.language is None:
             continue
         languages[r.language] += int(count)
 
-    #
-    # FRIENDS:
-    #
-    script = load_text_resource("graph_user_user.lua")
-    get_users = get_connection().register_script(script)
-    social = get_users(keys=["{0}".format(user.id).encode("ascii")],
-                       args=[flask.current_app.config["REDIS_PREFIX"]])
-    friends = []
-    if len(social):
-        ids = map(int, social[::2])
-        friends = list(zip(User.query.filter(User.id.in_(ids)).all(),
-                           map(int, social[1::2])))
-
-    #
-    # SIMILAR REPOS:
-    #
-    script = load_text_resource("graph_user_repo.lua")
-    get_repos = get_connection().register_script(script)
-    repo_scores = get_repos(keys=["{0}".format(user.id).encode("ascii")],
-                            args=[flask.current_app.config["REDIS_PREFIX"]])
-    repo_recs = []
-    if len(repo_scores):
-        ids = map(int, repo_scores[::2])
-        repo_recs = list(zip(Repo.query.filter(Repo.id.in_(ids)).all(),
-                             map(int, repo_scores[1::2])))
-
-    #
-    # SCHEDULE:
-    #
-    with get_pipeline() as pipe:
-        pipe.zrevrange(format_key("u:{0}:e".format(user.id)), 0, 4,
-                       withscores=True)
-        keys = [(k.decode("ascii"), c) for k, c in pipe.execute()[0]]
-        for k, _ in keys:
-            key = format_key("u:{0}:e:{1}".format(user.id, k))
-            pipe.hgetall(key)
-        schedule = dict(zip((k for k, _ in keys), pipe.execute()))
-    total_hist = dict((k, c) for k, c in keys)
+    total_hist = dict(events)
     week_hist = defaultdict(lambda: list([0 for _ in range(7)]))
     day_hist = defaultdict(lambda: list([0 for _ in range(24)]))
-    for t, vals in schedule.items():
-        for day, counts in vals.items():
-            counts = list(map(int, counts.decode("ascii").split(",")))
-            sm = sum(counts)
-            total_hist[t] += sm
-            week_hist[t][int(day)] += sm
-            for i, c in enumerate(counts):
-                day_hist[t][i] += c
+    for t, hist in schedule.items():
+        if not hist.any():
+            continue
+        total_hist[t] += int(hist.sum())
+        week_hist[t] = hist.sum(axis=1).tolist()
+        day_hist[t] = hist.sum(axis=0).tolist()
 
     # Correct for the timezone.
     if tz_offset and user.timezone:
@@ -100,18 +205,15 @@ def user_stats(username, tz_offset=True):
             h[i] += c
     descriptions = None
     norm = sqrt(sum([v * v for v in h]))
-    if norm > 0.0:
+    if norm > 0.0 and "descriptions" in fields:
         # A description of the most active day.
-        days = load_json_resource("days.json")
         h = [_ / norm for _ in h]
         best = -1.0
-        for d in days:
-            vector = d["vector"]
-            norm = 1.0 / sqrt(sum([v * v for v in vector]))
-            dot = sum([(v*norm-w) ** 2 for v, w in zip(vector, h)])
+        for name, vector in load_days():
+            dot = sum([(v-w) ** 2 for v, w in zip(vector, h)])
             if best < 0 or dot < best:
                 best = dot
-                day_desc = d["name"]
+                day_desc = name
 
         # A description of the most active time.
         time_desc = load_json_resource("times.json")
@@ -143,8 +245,7 @@ def user_stats(username, tz_offset=True):
         )
 
     # Build the results dictionary.
-    return dict(
-        user.basic_dict(),
+    stats = dict(
         descriptions=descriptions,
         total=int(sum(total_hist.values())),
         events=[{"type": t, "count": int(c)} for t, c in sorted(
@@ -155,61 +256,186 @@ def user_stats(username, tz_offset=True):
                    for l, c in sorted(languages.items(), reverse=True,
                                       key=operator.itemgetter(1))],
         repos=[dict(r.short_dict(), count=c) for r, c in repo_counts],
+        distinct_repos=distinct,
         friends=[dict(u.short_dict(), weight=c) for u, c in friends],
         repo_recs=[dict(r.short_dict(), weight=c) for r, c in repo_recs],
     )
+    return dict(user.basic_dict(), **_select(stats, fields))
+
 
+def repo_stats(username, reponame, window=None, fields=None):
+    payload = repo_payload(username, reponame, window=window, fields=fields)
+    if not payload:
+        return payload
+    return payload.data
 
-def repo_stats(username, reponame):
+
+def repo_payload(username, reponame, compressed=False, window=None,
+                 fields=None):
     repo = github.get_repo("{0}/{1}".format(username, reponame))
     if repo is None or not repo.active:
         return None
     if not repo.owner.is_active:
         return False
+    fields = _fields(fields, REPO_FIELDS)
+    return get_cached("r", repo.id,
+                      lambda: compute_repo_stats(repo, window=window,
+                                                 fields=fields),
+                      compressed=compressed,
+                      variant=_variant(window, fields, REPO_FIELDS))
+
+
+def repo_payloads(fullnames, compressed=False, window=None, fields=None):
+    """
+    The same as :func:`user_payloads` for a list of ``"owner/name"`` repo
+    names.
+
+    """
+    fields = _fields(fields, REPO_FIELDS)
+    repos = github.get_repos_by_name(fullnames)
+    results = dict()
+    active = dict()
+    for name in fullnames:
+        repo = repos.get(name.lower())
+        if repo is None or not repo.active:
+            results[name] = None
+        elif not repo.owner.is_active:
+            results[name] = False
+        else:
+            active[repo.id] = repo
+
+    def compute(ids):
+        stats = compute_repo_stats_many([active[id] for id in ids],
+                                        window=window, fields=fields)
+        return dict(zip(ids, stats))
+
+    payloads = get_cached_many("r", list(active.keys()), compute,
+                               compressed=compressed,
+                               variant=_variant(window, fields, REPO_FIELDS))
+    for name in fullnames:
+        if name not in results:
+            results[name] = payloads[repos[name.lower()].id]
+    return results
+
+
+def compute_repo_stats(repo, window=None, fields=None):
+    return compute_repo_stats_many([repo], window=window, fields=fields)[0]
+
+
+def compute_repo_stats_many(repos, window=None, fields=None):
+    fields = _fields(fields, REPO_FIELDS)
+    ids = [repo.id for repo in repos]
+    none = [[] for _ in ids]
 
     #
-    # CONTRIBUTORS:
+    # CONTRIBUTORS AND EVENT COUNTS:
     #
-    user_counts = []
-    conn = get_connection()
-    users = conn.zrevrange(format_key("r:{0}:u".format(repo.id)), 0, 4,
-                           withscores=True)
-    if len(users):
-        ids, counts = zip(*(map(lambda u: map(int, u), users)))
-        user_counts = list(zip(User.query.filter(User.id.in_(ids)).all(),
-                           counts))
+    want_users = "interactions" in fields
+    want_events = bool(fields & {"events", "total"})
+    keys = []
+    if want_users:
+        keys += _counter_keys(["r:{0}:u".format(id) for id in ids], window)
+    if want_events:
+        keys += _counter_keys(["r:{0}:e".format(id) for id in ids], window)
+    with get_pipeline() as pipe:
+        for key in keys:
+            pipe.zrevrange(key, 0, 4, withscores=True)
+        results = pipe.execute() if len(keys) else []
+    users = events = none
+    if want_users:
+        users = [[(int(u), int(c)) for u, c in values]
+                 for values in results[:len(ids)]]
+        results = results[len(ids):]
+    if want_events:
+        events = results
+    events = [dict((k.decode("ascii"), c) for k, c in values)
+              for values in events]
 
     #
     # SIMILAR REPOS:
     #
-    repo_recs = []
-    script = load_text_resource("graph_repo_repo.lua")
-    get_repos = get_connection().register_script(script)
-    social = get_repos(keys=["{0}".format(repo.id).encode("ascii")],
-                       args=[flask.current_app.config["REDIS_PREFIX"]])
-    if len(social):
-        ids = map(int, social[::2])
-        repo_recs = list(zip(Repo.query.filter(Repo.id.in_(ids)).all(),
-                             map(int, social[1::2])))
-    #
-    # EVENT COUNTS:
-    #
-    with get_pipeline() as pipe:
-        pipe.zrevrange(format_key("r:{0}:e".format(repo.id)), 0, 4,
-                       withscores=True)
-        event_counts = dict(((k.decode("ascii"), c)
-                             for k, c in pipe.execute()[0]))
+    graphs = none
+    if "repo_recs" in fields:
+        graphs = repo_graphs_many(ids)
+        graphs = [graphs[str(id)] for id in ids]
+    distinct = [None] * len(ids)
+    if "contributors" in fields:
+        distinct = distinct_counts_many("r", ids)
 
-    # Build the results dictionary.
-    return dict(
-        repo.basic_dict(),
-        owner=None if repo.owner is None else repo.owner.basic_dict(),
-        interactions=[dict(u.short_dict(), count=c) for u, c in user_counts],
-        repo_recs=[dict(r.short_dict(), weight=c) for r, c in repo_recs],
-        total=int(sum(event_counts.values())),
-        events=[{"type": t, "count": int(c)} for t, c in sorted(
-            event_counts.items(), reverse=True, key=operator.itemgetter(1))],
-    )
+    user_objs = github.get_users(set(u for values in users
+                                     for u, _ in values))
+    repo_objs = github.get_repos(set(int(r) for recs in graphs
+                                     for r in recs[::2]))
+
+    # Build the results dictionaries.
+    results = []
+    for repo, user_counts, event_counts, recs, contributors in zip(
+            repos, users, events, graphs, distinct):
+        user_counts = [(user_objs[u], c) for u, c in user_counts
+                       if u in user_objs]
+        repo_recs = _hydrate(repo_objs, recs)
+        stats = dict(
+            interactions=[dict(u.short_dict(), count=c)
+                          for u, c in user_counts],
+            contributors=contributors,
+            repo_recs=[dict(r.short_dict(), weight=c) for r, c in repo_recs],
+            total=int(sum(event_counts.values())),
+            events=[{"type": t, "count": int(c)} for t, c in sorted(
+                event_counts.items(), reverse=True,
+                key=operator.itemgetter(1))],
+        )
+        results.append(dict(
+            repo.basic_dict(),
+            owner=None if repo.owner is None else repo.owner.basic_dict(),
+            **_select(stats, fields)
+        ))
+    return results
+
+
+def _fields(fields, allowed):
+    # All of the sections unless a subset is requested.
+    if fields is None:
+        return frozenset(allowed)
+    return frozenset(fields) & frozenset(allowed)
+
+
+def _select(stats, fields):
+    return dict((k, v) for k, v in stats.items() if k in fields)
+
+
+def _variant(window, fields, allowed):
+    # The windowed stats and the subsets of the sections are cached
+    # separately from the full stats.
+    parts = []
+    if window is not None:
+        parts.append("m{0}".format(window))
+    if fields != frozenset(allowed):
+        parts.append(",".join(sorted(fields)) or "basic")
+    if not len(parts):
+        return None
+    return ":".join(parts)
+
+
+def _counter_keys(keys, window):
+    # The totals or the merges of the buckets for the last ``window`` months.
+    if window is None:
+        return [format_key(key) for key in keys]
+    return merged_zsets(keys, window)
+
+
+def _hydrate(objs, scores):
+    # Convert a flat [id, score, id, score, ...] list from one of the social
+    # graphs into (object, score) pairs using the loaded ``objs``, keeping
+    # the order of the list. The scores are counts unless the graphs come
+    # from the similarity engine.
+    ids = list(map(int, scores[::2]))
+    results = []
+    for id, c in zip(ids, scores[1::2]):
+        if id not in objs:
+            continue
+        c = float(c)
+        results.append((objs[id], int(c) if c.is_integer() else c))
+    return results
 
 
 def roll(x, shift):
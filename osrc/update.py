@@ -1,196 +1,223 @@
 # -*- coding: utf-8 -*-
 
+import os
 import time
 import json
 import gzip
 import flask
 import traceback
-from io import BytesIO
+from io import StringIO
 from multiprocessing import Pool
 from collections import defaultdict
 from datetime import date, timedelta
 
 from .models import db
 from .asyncdl import Downloader
+from .cache import invalidate
+from .graphs import mark_touched, refresh_graphs
+from .metrics import Metrics
+from .buckets import bucket_ttl
+from .distinct import window_ttl
+from .aggregate import Aggregator, EventBatch
 from .process import parse_datetime
-from .redis import get_pipeline, format_key, get_connection
+from .redis import get_connection, get_pipeline, reset_connection_pool
 
 
 # The URL template for the GitHub Archive.
 archive_url = ("http://data.githubarchive.org/"
                "{year}-{month:02d}-{day:02d}-{n}.json.gz")
 
+# The columns of the staging tables that are filled from the events.
+user_columns = ["id", "login", "avatar_url", "user_type", "name", "location"]
+repo_columns = ["id", "name", "fullname", "owner_id", "last_updated",
+                "language", "description", "fork", "star_count",
+                "watcher_count", "fork_count", "issues_count"]
+
+
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    return ("{0}".format(value)
+            .replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r"))
+
+
+def merge_sql(table, columns):
+    # Missing values are NULL in the staging table so the coalesce keeps the
+    # current value for any field that wasn't included in the events.
+    return """
+        LOCK TABLE {0} IN EXCLUSIVE MODE;
+
+        UPDATE {0}
+        SET {1}
+        FROM temp_{0}
+        where temp_{0}.id = {0}.id;
+
+        INSERT INTO {0}({2}, active)
+        SELECT {3}, TRUE
+        FROM temp_{0}
+        LEFT OUTER JOIN {0} ON ({0}.id = temp_{0}.id)
+        WHERE {0}.id IS NULL;
+    """.format(
+        table,
+        ", ".join("{1} = coalesce(temp_{0}.{1}, {0}.{1})".format(table, k)
+                  for k in columns if k != "id"),
+        ", ".join(columns),
+        ", ".join("temp_{0}.{1}".format(table, k) for k in columns)
+    )
+
 
 class Parser(object):
 
-    def __call__(self, args):
-        name, fh = args
+    def __init__(self, connection=None):
+        self.connection = connection
+
+    def __call__(self, filename):
         try:
-            return self.process(name, fh)
+            return self.process(filename)
         except Exception as e:
+            if self.connection is not None:
+                self.connection.rollback()
             print(e)
-            print(name)
+            print(filename)
             raise
 
-    def process(self, name, fh):
+    def process(self, filename):
+        self.reset(os.path.basename(filename))
+        with self.metrics.timer("total"):
+            self.read(filename)
+            self.flush_counts()
+            self.load_tables()
+            self.merge_tables()
+            self.connection.commit()
+
+        summary = self.metrics.summary()
+        print(json.dumps(summary, sort_keys=True))
+        return summary
+
+    def reset(self, name=None):
         self.users = defaultdict(dict)
         self.repos = defaultdict(dict)
-
-        c = db.engine.connect()
-        c.connection.autocommit = False
-        self.cursor = c.connection.cursor()
-
-        # Start by creating the temporary tables that we'll use for these
-        # events.
-        self.cursor.execute("""
-            create temporary table temp_gh_users(like gh_users)
-                on commit drop;
-            create temporary table temp_gh_repos(like gh_repos)
-                on commit drop;
-        """)
-
-        # Loop over events and fill the temporary tables.
-        strt = time.time()
+        self.events = EventBatch()
+        self.counts = Aggregator()
+        self.metrics = Metrics(file=name)
+
+    def read(self, filename):
+        # The file is decompressed and parsed line by line so that memory
+        # usage doesn't depend on the size of the archive. The stages are
+        # timed per line so the clock is read directly instead of through
+        # `Metrics.timer`.
         count = 0
-        with get_pipeline() as pipe:
-            with gzip.GzipFile(fileobj=BytesIO(fh)) as f:
-                for line in f:
-                    strt = time.time()
-                    evt = json.loads(line.decode("utf-8"))
-                    try:
-                        self._process_event(pipe, evt)
-                    except:
-                        print("failed to process event:")
-                        print(evt)
-                        print("  exception:")
-                        traceback.print_exc()
-                        continue
-                    count += 1
-            pipe.execute()
-
-        all_user_keys = set([])
-        for user in self.users.values():
-            keys = list(user.keys())
-            all_user_keys |= set(keys)
-            self.cursor.execute(
-                """
-                insert into temp_gh_users (
-                    {0}
-                ) values (
-                    {1}
-                )
-                """
-                .format(",".join(keys),
-                        ",".join(map("%({0})s".format, keys))),
-                user
-            )
-
-        all_repo_keys = set([])
-        for repo in self.repos.values():
-            keys = list(repo.keys())
-            all_repo_keys |= set(keys)
-            self.cursor.execute(
-                """
-                insert into temp_gh_repos (
-                    {0}
-                ) values (
-                    {1}
-                )
-                """
-                .format(",".join(keys),
-                        ",".join(map("%({0})s".format, keys))),
-                repo
-            )
-
+        failures = 0
+        decompress = decode = process = 0.0
+        clock = time.perf_counter
+        with gzip.open(filename, "rb") as f:
+            while True:
+                t0 = clock()
+                line = f.readline()
+                t1 = clock()
+                decompress += t1 - t0
+                if not line:
+                    break
+                evt = json.loads(line.decode("utf-8"))
+                t2 = clock()
+                decode += t2 - t1
+                try:
+                    self._process_event(evt)
+                except:
+                    print("failed to process event:")
+                    print(evt)
+                    print("  exception:")
+                    traceback.print_exc()
+                    failures += 1
+                    continue
+                finally:
+                    process += clock() - t2
+                count += 1
+
+        self.metrics.add_time("decompress", decompress)
+        self.metrics.add_time("decode", decode)
+        self.metrics.add_time("process", process)
+        self.metrics.incr("bytes", os.path.getsize(filename))
+        self.metrics.incr("events", count)
+        self.metrics.incr("failures", failures)
+        return count
+
+    def flush_counts(self):
+        # Compute and send the aggregated counts for the whole file.
+        with self.metrics.timer("aggregate"):
+            self.events.aggregate(self.counts, window_ttl=window_ttl(),
+                                  bucket_ttl=bucket_ttl())
+        with self.metrics.timer("redis"):
+            with get_pipeline() as pipe:
+                config = flask.current_app.config
+                ncmd = self.counts.flush(pipe, config["REDIS_DEFAULT_TTL"],
+                                         cap=config["SOCIAL_ZSET_CAP"])
+
+                # Mark the cached stats of everything we touched as stale.
+                ncmd += invalidate(pipe, "u", self.users.keys())
+                ncmd += invalidate(pipe, "r", self.repos.keys())
+
+                # Queue the social graphs that need to be recomputed.
+                ncmd += mark_touched(pipe, "u", set(self.events.actors))
+                ncmd += mark_touched(pipe, "r", set(self.events.repos))
+                pipe.execute()
+        self.metrics.incr("redis_commands", ncmd)
+        return ncmd
+
+    def load_tables(self):
+        if self.connection is None:
+            self.connection = db.engine.raw_connection()
+        self.cursor = self.connection.cursor()
+
+        with self.metrics.timer("load"):
+            # Start by creating the temporary tables that we'll use for
+            # these events.
+            self.cursor.execute("""
+                create temporary table temp_gh_users(like gh_users)
+                    on commit drop;
+                create temporary table temp_gh_repos(like gh_repos)
+                    on commit drop;
+            """)
+
+            # Bulk load the accumulated users and repos.
+            self._copy_rows("temp_gh_users", user_columns,
+                            self.users.values())
+            self._copy_rows("temp_gh_repos", repo_columns,
+                            self.repos.values())
+
+        self.metrics.incr("user_rows", len(self.users))
+        self.metrics.incr("repo_rows", len(self.repos))
+        return len(self.users) + len(self.repos)
+
+    def merge_tables(self):
         # Copy the temporary tables.
-        self.cursor.execute("""
-            LOCK TABLE gh_users IN EXCLUSIVE MODE;
-
-            UPDATE gh_users
-            SET {0}
-            FROM temp_gh_users
-            where temp_gh_users.id = gh_users.id;
-
-            INSERT INTO gh_users({1}, active)
-            SELECT {2}, TRUE
-            FROM temp_gh_users
-            LEFT OUTER JOIN gh_users ON (gh_users.id = temp_gh_users.id)
-            WHERE gh_users.id IS NULL;
-        """.format(
-            ", ".join(map("{0} = coalesce(temp_gh_users.{0}, gh_users.{0})"
-                            .format,
-                            all_user_keys)),
-            ", ".join(all_user_keys),
-            ", ".join(map("temp_gh_users.{0}".format, all_user_keys))
-        ))
-
-        self.cursor.execute("""
-            LOCK TABLE gh_repos IN EXCLUSIVE MODE;
-
-            UPDATE gh_repos
-            SET {0}
-            FROM temp_gh_repos
-            where temp_gh_repos.id = gh_repos.id;
-
-            INSERT INTO gh_repos({1}, active)
-            SELECT {2}, TRUE
-            FROM temp_gh_repos
-            LEFT OUTER JOIN gh_repos ON (gh_repos.id = temp_gh_repos.id)
-            WHERE gh_repos.id IS NULL;
-        """.format(
-            ", ".join(map("{0} = coalesce(temp_gh_repos.{0}, gh_repos.{0})"
-                            .format,
-                            all_repo_keys)),
-            ", ".join(all_repo_keys),
-            ", ".join(map("temp_gh_repos.{0}".format, all_repo_keys))
-        ))
-
-        # self.cursor.execute("commit;")
-
-        print("... processed {0} events in {1} seconds"
-              .format(count, time.time() - strt))
-
-    def _redis_execute(self, pipe, cmd, key, *args, **kwargs):
-        key = format_key(key)
-        getattr(pipe, cmd)(key, *args, **kwargs)
-        pipe.expire(key, flask.current_app.config["REDIS_DEFAULT_TTL"])
-
-    def _redis_update_hist(self, pipe, key, day, hour):
-        key = format_key(key)
-        hist = get_connection().hget(key, day)
-        if hist is None:
-            hist = [0] * 24
-        else:
-            hist = list(map(int, hist.decode("ascii").split(",")))
-        hist[hour] += 1
-        pipe.hset(key, day, ",".join(map("{0}".format, hist)))
+        with self.metrics.timer("merge"):
+            self.cursor.execute(merge_sql("gh_users", user_columns))
+            self.cursor.execute(merge_sql("gh_repos", repo_columns))
+
+    def _copy_rows(self, table, columns, rows):
+        buf = StringIO()
+        for row in rows:
+            buf.write("\t".join(copy_value(row.get(k)) for k in columns))
+            buf.write("\n")
+        buf.seek(0)
+        self.cursor.copy_expert(
+            "COPY {0} ({1}) FROM STDIN".format(table, ", ".join(columns)),
+            buf
+        )
 
-    def _process_event(self, pipe, event):
+    def _process_event(self, event):
         # Process the event's user and repo.
         user_id = self._process_user(event["actor"])
         repo_id = self._process_repo(event["repo"])
 
-        # Extract the relevant information from the event
-        evt = event["type"][:-5]
-        dt = parse_datetime(event["created_at"])
-        day = dt.weekday()
-        hour = dt.hour
-
-        # Social counts
-        key = "u:{0}:r".format(user_id)
-        self._redis_execute(pipe, "zincrby", key, repo_id, 1)
-        key = "r:{0}:u".format(repo_id)
-        self._redis_execute(pipe, "zincrby", key, user_id, 1)
-
-        # User-event counts and histogram
-        key = "u:{0}:e".format(user_id)
-        self._redis_execute(pipe, "zincrby", key, evt, 1)
-        key = "u:{0}:e:{1}".format(user_id, evt)
-        self._redis_update_hist(pipe, key, day, hour)
-
-        # Repo-event counts
-        key = "r:{0}:e".format(repo_id)
-        self._redis_execute(pipe, "zincrby", key, evt, 1)
+        # Buffer the fields needed for the counters. These are aggregated
+        # for the whole file at once in `EventBatch.aggregate`.
+        self.events.append(user_id, repo_id, event["type"][:-5],
+                           event["created_at"])
 
         # Parse any event specific elements.
         parser = self.event_types.get(event["type"], None)
@@ -272,11 +299,36 @@ class Parser(object):
     )
 
 
-def update(files=None, since=None):
-    parser = Parser()
-    pool = Pool()
+# The parser for the current worker process; see `init_worker`.
+worker_parser = None
+
+
+def init_worker():
+    global worker_parser
+
+    # The parent closes its pooled connections before forking (see
+    # `update`) so each worker opens its own and keeps them for all of the
+    # files that it processes.
+    reset_connection_pool()
+    worker_parser = Parser(db.engine.raw_connection())
+
+
+def process_file(filename):
+    return worker_parser(filename)
+
+
+def update(files=None, since=None, metrics_file=None):
+    # Close the pooled database and Redis connections before forking.
+    # Otherwise the workers inherit the sockets and closing them there would
+    # tear them down under the parent. They are reopened when needed.
+    db.engine.dispose()
+    get_connection().connection_pool.disconnect()
+    pool = Pool(initializer=init_worker)
+    totals = Metrics()
     if files is not None:
-        list(pool.map(parser, ((fn, open(fn, "rb").read()) for fn in files)))
+        for summary in pool.map(process_file, files):
+            totals.merge(summary)
+        update_graphs(totals)
     else:
         today = date.today()
         if since is None:
@@ -287,24 +339,62 @@ def update(files=None, since=None):
 
         print("updating since '{0}'".format(since))
 
-        dler = Downloader()
+        dler = Downloader(flask.current_app.config["ARCHIVE_SPOOL_DIR"])
         while since < today:
             base_date = dict(
                 year=since.year,
                 month=since.month,
                 day=since.day,
             )
+            day = Metrics(day="{year}-{month:02d}-{day:02d}"
+                              .format(**base_date))
 
             print("downloading files for {year}-{month:02d}-{day:02d}"
                   .format(**base_date))
             urls = [archive_url.format(**(dict(base_date, n=n)))
                     for n in range(24)]
-            strt = time.time()
-            results = dler.download(
-                urls, request_timeout=30*60, connect_timeout=30*60
-            )
-            print("download took {0} seconds...".format(time.time()-strt))
-
-            list(pool.map(parser, results.items()))
+            with day.timer("download"):
+                results = dler.download(
+                    urls, request_timeout=30*60, connect_timeout=30*60
+                )
+            day.incr("files", len(results))
+            print("download took {0} seconds..."
+                  .format(day.seconds["download"]))
+
+            try:
+                for summary in pool.map(process_file, results.values()):
+                    day.merge(summary)
+            finally:
+                for fn in results.values():
+                    os.remove(fn)
+
+            update_graphs(day)
+            summary = day.summary()
+            print(json.dumps(summary, sort_keys=True))
+            totals.merge(summary)
+            if metrics_file is not None:
+                write_metrics(metrics_file, totals)
 
             since += timedelta(1)
+
+    if metrics_file is not None:
+        write_metrics(metrics_file, totals)
+    return totals.summary()
+
+
+def update_graphs(metrics):
+    # Precompute the recommendation graphs of everything that was touched
+    # so that the stats pages don't have to build them on request.
+    with metrics.timer("graphs"):
+        nusers, nrepos = refresh_graphs()
+    metrics.incr("graph_users", nusers)
+    metrics.incr("graph_repos", nrepos)
+
+
+def write_metrics(filename, metrics):
+    # Write to a temporary file first so that a scraper never reads a
+    # partial dump.
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(metrics.prometheus("osrc_update"))
+    os.rename(tmp, filename)
@@ -4,29 +4,124 @@ import os
 import re
 import json
 import flask
+import threading
+from math import sqrt
+from types import MappingProxyType
 
-__all__ = ["load_resource", "load_json_resource", "load_text_resource",
-           "is_robot"]
-
-def load_resource(
-    filename,
-    base=os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"),
-    handler=lambda fh: fh.read()
-):
-    if "resources" not in flask.g:
-        flask.g.resources = dict()
-    if filename not in flask.g.resources:
-        with open(os.path.join(base, filename), "r") as f:
-            flask.g.resources[filename] = handler(f)
-    return flask.g.resources[filename]
+__all__ = ["ResourceRegistry", "resources", "init_resources",
+           "load_resource", "load_json_resource", "load_text_resource",
+           "load_optouts", "load_days", "is_robot"]
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+class ResourceRegistry(object):
+    """
+    A process-wide cache of the files in ``osrc/data``. Each file is parsed
+    once by a handler and the result is shared, read-only, by every request.
+    If ``reload`` is set, a file is parsed again when its mtime changes.
+
+    """
+
+    def __init__(self, base=DATA_DIR, reload=False):
+        self.base = base
+        self.reload = reload
+        self.lock = threading.Lock()
+        self.entries = dict()
+
+    def get(self, filename, handler, base=None):
+        path = os.path.join(self.base if base is None else base, filename)
+        key = (path, handler)
+        entry = self.entries.get(key)
+        if entry is not None and not self.reload:
+            return entry[1]
+        mtime = os.path.getmtime(path)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        with self.lock:
+            with open(path, "r") as f:
+                value = handler(f)
+            self.entries[key] = (mtime, value)
+        return value
+
+    def preload(self):
+        for filename in sorted(os.listdir(self.base)):
+            ext = os.path.splitext(filename)[1]
+            if ext in _handlers:
+                self.get(filename, _handlers[ext])
+
+
+def _freeze(value):
+    # Make the parsed JSON immutable since it is shared between requests.
+    if isinstance(value, dict):
+        return MappingProxyType(dict((k, _freeze(v))
+                                     for k, v in value.items()))
+    if isinstance(value, list):
+        return tuple(map(_freeze, value))
+    return value
+
+
+def _read_text(fh):
+    return fh.read()
+
+
+def _read_json(fh):
+    return _freeze(json.load(fh))
+
+
+def _read_optouts(fh):
+    return frozenset(name.lower() for name in json.load(fh))
+
+
+def _read_days(fh):
+    # The "days" vectors normalised to unit length.
+    days = []
+    for d in json.load(fh):
+        norm = sqrt(sum(v * v for v in d["vector"]))
+        days.append((d["name"], tuple(v / norm for v in d["vector"])))
+    return tuple(days)
+
+
+_handlers = {".json": _read_json, ".lua": _read_text, ".txt": _read_text}
+
+resources = ResourceRegistry()
+
+
+def init_resources(app):
+    """
+    Load all of the resources when the app is created.
+
+    """
+    resources.reload = app.config["RESOURCE_RELOAD"]
+    resources.preload()
+    load_optouts()
+    load_days()
+
+
+def load_resource(filename, base=None, handler=_read_text):
+    return resources.get(filename, handler, base=base)
 
 def load_json_resource(filename, **kwargs):
-    kwargs["handler"] = json.load
+    kwargs["handler"] = _read_json
     return load_resource(filename, **kwargs)
 
 def load_text_resource(filename, **kwargs):
     return load_resource(filename, **kwargs)
 
+def load_optouts():
+    """
+    The lowercase logins of the users who opted out.
+
+    """
+    return load_resource("optout.json", handler=_read_optouts)
+
+def load_days():
+    """
+    The ``(name, unit vector)`` pairs from ``days.json``.
+
+    """
+    return load_resource("days.json", handler=_read_days)
+
 def is_robot():
     """
     Adapted from: https://github.com/jpvanhal/flask-split
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the GitHub refresh queue (``osrc.github.drain_refresh_queue``)
+against a local stub of the GitHub API.
+
+They need a Redis server: set ``OSRC_TEST_REDIS_URI`` (default:
+``redis://localhost:6379/15``). Only the keys with the ``osrc-test`` prefix
+are touched. The database is an in-memory SQLite database.
+
+"""
+
+import os
+import json
+import time
+import redis
+import tempfile
+import threading
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+from osrc import create_app, httpclient
+from osrc.models import db, User
+from osrc.redis import get_connection, reset_connection_pool, format_key
+from osrc.github import enqueue_refresh, drain_refresh_queue
+from osrc.httpclient import RateLimited
+
+REDIS_URI = os.environ.get("OSRC_TEST_REDIS_URI", "redis://localhost:6379/15")
+
+
+class StubGitHub(BaseHTTPRequestHandler):
+    """
+    Serves the ``responses`` (``{path: (status, headers, body)}``) and
+    records the path and ``If-None-Match`` header of every request.
+
+    """
+
+    responses = dict()
+    requests = []
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        self.requests.append((path, self.headers.get("If-None-Match")))
+        status, headers, body = self.responses.get(path, (404, {}, {}))
+        body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        if status != 304:
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def user_json(id, login, name):
+    return dict(id=id, login=login, name=name, type="User",
+                avatar_url="https://example.com/{0}.png".format(login))
+
+
+class RefreshQueueTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(("127.0.0.1", 0), StubGitHub)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+        fd, cls.settings = tempfile.mkstemp(suffix=".py")
+        with os.fdopen(fd, "w") as f:
+            f.write("\n".join([
+                "SQLALCHEMY_DATABASE_URI = 'sqlite://'",
+                "REDIS_PREFIX = 'osrc-test'",
+                "GITHUB_API_URL = 'http://127.0.0.1:{0}'".format(
+                    cls.server.server_port),
+                "GITHUB_RATELIMIT_RESERVE = 0",
+                "HTTP_RETRIES = 0",
+            ]) + "\n")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        os.remove(cls.settings)
+
+    def setUp(self):
+        self.app = create_app(self.settings)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        reset_connection_pool(redis.ConnectionPool.from_url(REDIS_URI))
+        try:
+            get_connection().ping()
+        except redis.exceptions.ConnectionError:
+            self.ctx.pop()
+            reset_connection_pool()
+            self.skipTest("no Redis server at {0}".format(REDIS_URI))
+        self._clear_redis()
+
+        # Start with a fresh rate limit budget.
+        httpclient._clients = dict()
+        StubGitHub.responses = dict()
+        StubGitHub.requests = []
+
+        db.create_all()
+        for id, login in [(1, "alice"), (2, "bob"), (3, "carol")]:
+            db.session.add(User(id=id, login=login, name=login,
+                                user_type="User", etag="etag-{0}".format(id)))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self._clear_redis()
+        self.ctx.pop()
+        reset_connection_pool()
+
+    def _clear_redis(self):
+        conn = get_connection()
+        keys = list(conn.scan_iter(match=format_key("*")))
+        if len(keys):
+            conn.delete(*keys)
+
+    def _queue(self):
+        return [m.decode("ascii") for m in get_connection().zrange(
+            format_key("q:refresh"), 0, -1)]
+
+    def test_enqueue_keeps_the_first_time(self):
+        enqueue_refresh("u", [1, 2])
+        key = format_key("q:refresh")
+        score = get_connection().zscore(key, "u:1")
+        time.sleep(0.01)
+        enqueue_refresh("u", [1])
+        enqueue_refresh("r", [1])
+        self.assertEqual(get_connection().zscore(key, "u:1"), score)
+        self.assertEqual(self._queue(), ["u:1", "u:2", "r:1"])
+
+    def test_drain_pops_the_oldest_entries(self):
+        conn = get_connection()
+        conn.zadd(format_key("q:refresh"), 3, "u:1", 1, "u:2", 2, "u:3")
+        StubGitHub.responses = {
+            "/users/bob": (304, {}, None),
+            "/users/carol": (200, {"ETag": "etag-new"},
+                             user_json(3, "carol", "Carol")),
+        }
+
+        self.assertEqual(drain_refresh_queue(limit=2), 2)
+        self.assertEqual(self._queue(), ["u:1"])
+        self.assertEqual(sorted(StubGitHub.requests),
+                         [("/users/bob", "etag-2"),
+                          ("/users/carol", "etag-3")])
+
+        # Both are marked as up to date but only the changed one has stale
+        # stats.
+        self.assertTrue(conn.getbit(format_key("c:u:2"), 0))
+        self.assertTrue(conn.getbit(format_key("c:u:3"), 0))
+        self.assertIsNone(conn.get(format_key("x:u:2:v")))
+        self.assertEqual(conn.get(format_key("x:u:3:v")), b"1")
+        user = User.query.filter(User.id == 3).first()
+        self.assertEqual((user.name, user.etag), ("Carol", "etag-new"))
+
+        # Anything refreshed since it was queued is skipped.
+        enqueue_refresh("u", [2])
+        self.assertEqual(drain_refresh_queue(limit=10), 2)
+        self.assertEqual(self._queue(), [])
+        self.assertEqual([p for p, _ in StubGitHub.requests[2:]],
+                         ["/users/alice"])
+
+    def test_rate_limited_requeues_the_rest(self):
+        reset = str(int(time.time()) + 3600)
+        StubGitHub.responses = {
+            "/users/alice": (304, {"X-RateLimit-Remaining": "0",
+                                   "X-RateLimit-Reset": reset}, None),
+        }
+        enqueue_refresh("u", [1, 2, 3])
+        enqueue_refresh("r", [10])
+
+        with self.assertRaises(RateLimited):
+            drain_refresh_queue(limit=10)
+
+        # Only the first request was made and the rest are queued again.
+        self.assertEqual([p for p, _ in StubGitHub.requests],
+                         ["/users/alice"])
+        self.assertEqual(sorted(self._queue()), ["r:10", "u:2", "u:3"])
+
+
+if __name__ == "__main__":
+    unittest.main()